@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Compare the size and decode time of JSON and binary song payloads.
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from db import dirtree as dt
+from db.xapian_music import encode_song, decode_song
+
+MUSIC_DIR = os.path.join(os.path.dirname(__file__), "..", "test", "music_dir")
+ROUNDS = 20000
+
+def timed(decode, payloads):
+  start_time = time.time()
+  for _ in xrange(ROUNDS):
+    for payload in payloads:
+      decode(payload)
+  return (time.time() - start_time) / (ROUNDS * len(payloads))
+
+def main(args):
+  songs = list(dt.get_songs(args[1] if len(args) > 1 else MUSIC_DIR))
+  json_payloads = [json.dumps(dict(song)) for song in songs]
+  binary_payloads = [encode_song(song) for song in songs]
+
+  json_size = sum(len(p) for p in json_payloads) / float(len(songs))
+  binary_size = sum(len(p) for p in binary_payloads) / float(len(songs))
+  json_time = timed(json.loads, json_payloads)
+  binary_time = timed(decode_song, binary_payloads)
+
+  print "payload   bytes/song   µs/decode"
+  print "json      %10.1f   %9.2f" % (json_size, json_time * 1e6)
+  print "binary    %10.1f   %9.2f" % (binary_size, binary_time * 1e6)
+  print "binary payloads are %.0f%% smaller and decode %.1f times faster." % \
+      (100 * (1 - binary_size / json_size), json_time / binary_time)
+
+if __name__ == "__main__":
+  main(sys.argv)
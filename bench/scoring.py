@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Compare scoring playlist entries against a whole synthetic library
+# with a loop of Levenshtein.ratio() calls and with playlist.scoring.
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from playlist.match import levenshtein_ok
+from playlist.normalize import normalize, with_keys
+from playlist.scoring import SongScorer
+
+LIBRARY_SIZE = 100000
+QUERIES = 20
+WORDS = (u"love night heart fire dance dream light world time life "
+         u"blue rain star song road home girl baby summer river "
+         u"ghost city electric golden wild young forever nation").split()
+
+def title(rnd):
+  return u" ".join(rnd.choice(WORDS) for _ in xrange(rnd.randint(1, 5))).title()
+
+def library(rnd, size):
+  return list(with_keys((title(rnd), title(rnd), u"/music/%d.mp3" % i, None)
+                        for i in xrange(size)))
+
+def loop_matches(songs, entry):
+  ls_title = normalize(entry["title"])
+  ls_artist = normalize(entry["artist"])
+  return [pos for pos, song in enumerate(songs)
+          if levenshtein_ok(fl_title=song[4], fl_artist=song[5],
+                            ls_artist=ls_artist, ls_title=ls_title)]
+
+def main(args):
+  size = int(args[1]) if len(args) > 1 else LIBRARY_SIZE
+  rnd = random.Random(1)
+  songs = library(rnd, size)
+  entries = [{"title" : song[0], "artist" : song[1]}
+             for song in rnd.sample(songs, QUERIES)]
+
+  start_time = time.time()
+  expected = [loop_matches(songs, entry) for entry in entries]
+  loop_time = (time.time() - start_time) / QUERIES
+
+  start_time = time.time()
+  scorer = SongScorer(songs)
+  setup_time = time.time() - start_time
+
+  start_time = time.time()
+  found = [scorer.matches(entry) for entry in entries]
+  batch_time = (time.time() - start_time) / QUERIES
+
+  assert found == expected
+
+  print "%d songs, %d playlist entries" % (size, QUERIES)
+  print "ratio() loop     %8.1f ms/entry" % (loop_time * 1e3)
+  print "batched scoring  %8.1f ms/entry (%.1f s setup)" % \
+      (batch_time * 1e3, setup_time)
+  print "batched scoring is %.1f times faster per entry." % \
+      (loop_time / batch_time)
+
+if __name__ == "__main__":
+  main(sys.argv)
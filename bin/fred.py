@@ -2,28 +2,124 @@
 # -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
 
 # Fred: a xapian-backed music search utility.
+#
+# fred.py QUERY...         search the index
+# fred.py index            bring the index up to date with MUSIC_DIR
+# fred.py index --shards N  the same, built as N shards in parallel
+# fred.py export [FILE]    write all songs to FILE (or stdout) as NDJSON
+# fred.py compact          rebuild and compact the index, e.g. nightly
+#
+# Searching never touches the music directory; run fred.py index, or
+# keep fredd.py running, to keep the index up to date.
 import sys
 import os
 import time
+import multiprocessing
 from db import xapian_music as db
 
 CURRENT_DIR = os.path.dirname(__file__)
 DBPATH = os.path.join(CURRENT_DIR, "music.db")
 #MUSIC_DIR = os.path.join(CURRENT_DIR, "test/music_dir")
 MUSIC_DIR = "/var/storage/Musik/"
+PAGE_SIZE = 50
+
+def search(args):
+    "Print the songs matching the query args, a page at a time."
+    start_time = time.time()
+
+    if not os.path.isdir(DBPATH):
+        sys.stderr.write("E: No index at %s, run fred.py index first.\n"
+                         % DBPATH)
+        return 1
+
+    # Print a page at a time, so the first results show up at once.
+    querystring = " ".join(args)
+    found = 0
+    while True:
+        page = db.search_page(dbpath=DBPATH, querystring=querystring,
+                              offset=found, limit=PAGE_SIZE)
+        for match in page.matches:
+            print u"{tracknumber} {artist} – »{title}« from {album} {year} ({length} s). Last modified {mtime}. Tagged {tags}.".format(**match['data'])
+        found += len(page.matches)
+        if len(page.matches) < PAGE_SIZE:
+            break
+    print "N: Found %i tracks in  in %f ms.\n" % (found, (time.time() - start_time)*1000)
+
+def index(args):
+    "Bring the index up to date with the music directory."
+    start_time = time.time()
+    shards = None
+    if args[:1] == ["--shards"]:
+        shards = int(args[1])
+
+    # Once sharded, always sharded.
+    if shards or db.shard_dirs(DBPATH):
+        db.index_sharded(datapath = MUSIC_DIR, dbpath = DBPATH,
+                         shards = shards)
+    else:
+        db.index(datapath = MUSIC_DIR, dbpath = DBPATH)
+    print "N: Indexed %s in %f s." % (MUSIC_DIR, time.time() - start_time)
+
+def export(args):
+    "Write every song in the index to a file, or stdout, as NDJSON."
+    if not os.path.isdir(DBPATH):
+        sys.stderr.write("E: No index at %s, run fred.py index first.\n"
+                         % DBPATH)
+        return 1
 
-def main(args):
     start_time = time.time()
-    
-    db.index(datapath = MUSIC_DIR, dbpath = DBPATH)
-    
-    #db.tag(dbpath=DBPATH, querystring=" ".join(args[1:]), tags=["inbox", "fisk"])
-    
-    matches = db.search(dbpath=DBPATH, querystring=" ".join(args[1:]))
-    for match in matches:
-        print u"{tracknumber} {artist} – »{title}« from {album} {year} ({length} s). Last modified {mtime}. Tagged {tags}.".format(**match['data'])
-    print "N: Found %i tracks in  in %f ms.\n" % (len(matches), (time.time() - start_time)*1000)
-    
+    last_report = [start_time]
+    def progress(count, size, elapsed):
+        # Every second or so, not for every block.
+        if time.time() - last_report[0] >= 1:
+            last_report[0] = time.time()
+            sys.stderr.write("N: %d songs, %.1f MB/s.\n" %
+                             (count, size / elapsed / 1e6))
+
+    # A pool of one process would only add overhead.
+    cpus = multiprocessing.cpu_count()
+    processes = cpus if cpus > 1 else None
+
+    out = open(args[0], "wb") if args else sys.stdout
+    try:
+        count, size = db.export(DBPATH, out, processes=processes,
+                                progress=progress)
+    finally:
+        if args:
+            out.close()
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    sys.stderr.write("N: Exported %d songs (%d bytes) in %f s, %d songs/s.\n"
+                     % (count, size, elapsed, count / elapsed))
+
+def compact(args):
+    """Rebuild the value slots of the index and compact it, and report
+    how that changed its size and the time of some typical queries."""
+    if not os.path.isdir(DBPATH):
+        sys.stderr.write("E: No index at %s, run fred.py index first.\n"
+                         % DBPATH)
+        return 1
+
+    start_time = time.time()
+    report = db.compact(DBPATH)
+    before, after = report['size']
+    print "N: Compacted %d songs in %f s, %.1f MB -> %.1f MB." % \
+        (report['documents'], time.time() - start_time,
+         before / 1e6, after / 1e6)
+    for querystring, before, after in report['latency']:
+        print "N: %-30s %8.3f ms -> %8.3f ms" % \
+            (querystring, before * 1000, after * 1000)
+
+COMMANDS = {"compact" : compact,
+            "export" : export,
+            "index" : index,
+            "search" : search}
+
+def main(args):
+    # Anything that isn't a command is a search.
+    if len(args) > 1 and args[1] in COMMANDS:
+        return COMMANDS[args[1]](args[2:])
+    return search(args[1:])
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
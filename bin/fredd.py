@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Fredd: keeps the index of fred.py up to date by watching the music
+# directory with inotify, so that searching never has to walk it.
+import argparse
+import logging
+import os
+import sys
+import time
+import pyinotify
+from db import xapian_music as db
+from fred import DBPATH, MUSIC_DIR
+
+# Files are indexed once written and closed; directories as soon as
+# they appear, as their files may be copied in before they are watched.
+MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+        pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE | pyinotify.IN_CREATE)
+
+# Seconds without changes before they are written to the index, so
+# that e.g. an album being copied is indexed in one go...
+QUIET_TIME = 2.0
+# ...but never later than this many seconds after the first of them.
+MAX_DELAY = 30.0
+
+
+class Changes(pyinotify.ProcessEvent):
+  """Collects the paths that have changed since they were last
+  written to the index, and tells when it's time to write them."""
+
+  def my_init(self, quiet_time=QUIET_TIME, max_delay=MAX_DELAY):
+    self.quiet_time = quiet_time
+    self.max_delay = max_delay
+    self.paths = set()
+    self.first = None
+    self.last = None
+    self.overflow = False
+
+  def process_default(self, event):
+    if event.mask & pyinotify.IN_CREATE and not event.dir:
+      # Wait for it to be written.
+      return
+    now = time.time()
+    if not self.paths:
+      self.first = now
+    self.last = now
+    self.paths.add(event.pathname)
+
+  def process_IN_Q_OVERFLOW(self, event):
+    # Events have been lost, so we can't know what has changed.
+    logging.warning("Too many changes at once, reindexing everything.")
+    self.overflow = True
+    self.first = self.last = time.time()
+
+  def due(self, now):
+    "Is it time to write the changes collected so far?"
+    if not self.paths and not self.overflow:
+      return False
+    return (now - self.last >= self.quiet_time or
+            now - self.first >= self.max_delay)
+
+  def take(self):
+    """Return the list of changed paths, and forget about them. None
+    means that anything might have changed. Paths under a changed
+    directory are left out, as the whole directory is indexed."""
+    paths = None if self.overflow else sorted(p for p in self.paths
+                                              if not self.covered(p))
+    self.paths = set()
+    self.overflow = False
+    return paths
+
+  def covered(self, path):
+    "Is a directory above path among the changed paths?"
+    parent = os.path.dirname(path)
+    while parent != path:
+      if parent in self.paths:
+        return True
+      path, parent = parent, os.path.dirname(parent)
+    return False
+
+
+def watch(music_dir, dbpath, quiet_time=QUIET_TIME, max_delay=MAX_DELAY):
+  "Keep the index at dbpath up to date with music_dir, forever."
+  wm = pyinotify.WatchManager()
+  changes = Changes(quiet_time=quiet_time, max_delay=max_delay)
+  notifier = pyinotify.Notifier(wm, changes, timeout=int(quiet_time * 1000))
+  # Watch first, so nothing changing while we catch up is missed.
+  wm.add_watch(music_dir, MASK, rec=True, auto_add=True)
+
+  # Sharded indexes can't be updated a file at a time, only reindexed.
+  sharded = bool(db.shard_dirs(dbpath))
+  reindex = db.index_sharded if sharded else db.index
+
+  logging.info("Catching up with %s." % music_dir)
+  reindex(datapath=music_dir, dbpath=dbpath)
+
+  try:
+    while True:
+      if notifier.check_events():
+        notifier.read_events()
+        notifier.process_events()
+
+      if changes.due(time.time()):
+        paths = changes.take()
+        start_time = time.time()
+        if paths is None or sharded:
+          reindex(datapath=music_dir, dbpath=dbpath)
+        else:
+          db.update(dbpath, paths)
+        logging.info("Indexed %s changed paths in %f s." %
+                     ("all" if paths is None else len(paths),
+                      time.time() - start_time))
+  finally:
+    notifier.stop()
+
+def main(args):
+  parser = argparse.ArgumentParser(
+    description="Keep the fred.py index up to date as music files change.")
+  parser.add_argument("--music", default=MUSIC_DIR, metavar="DIR",
+                      help="music directory to watch (default %(default)s)")
+  parser.add_argument("--db", default=DBPATH, metavar="PATH",
+                      help="index to keep up to date (default %(default)s)")
+  parser.add_argument("--quiet-time", type=float, default=QUIET_TIME,
+                      metavar="SECONDS",
+                      help="wait for SECONDS without changes before "
+                      "indexing them (default %(default)s)")
+  options = parser.parse_args(args[1:])
+
+  logging.basicConfig(level=logging.INFO,
+                      format="%(asctime)s %(levelname)s: %(message)s")
+  try:
+    watch(options.music, options.db, options.quiet_time)
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  main(sys.argv)
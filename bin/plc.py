@@ -1,46 +1,147 @@
 #!/usr/bin/env python
 # -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
 # This is a reference playlist compiler.
+import argparse
+import codecs
 import time
 import os
 import sys
 from playlist import transport as ts
 from playlist import m3u
-from playlist.match import match_transport
+from playlist.normalize import with_keys
+from playlist.match import match_transport, match_xapian, SongIndex, \
+    LENGTH_WINDOW
 from db import rhythmbox as rb
+from db import snapshot
 from db import dirtree
 
 RB_DB = os.path.expanduser('~/.local/share/rhythmbox/rhythmdb.xml')
+RB_SNAPSHOT = os.path.expanduser('~/.cache/music-tools/rhythmdb.snapshot')
 CURRENT_DIR = os.path.dirname(__file__)
 
-if len(sys.argv) > 1 and not len(sys.argv) > 2:
-  playlist = ts.load(sys.argv[1])
-else:
-  sys.stderr.write("Usage: plc <playlist file> <optional output file>. "
-                   "If no output file is given, print to stdout.\n")
-  sys.exit()
+# Name of the report of unmatched songs written in batch mode.
+REPORT_NAME = "unmatched.txt"
 
-start_time = time.time()
+def missing(playlist, songs):
+  "Return a list of error lines for the songs of playlist not found."
+  return ["couldn't find %d: %s by %s." %
+          ((i+1), playlist["playlist"][i]["title"],
+           playlist["playlist"][i]["artist"])
+          for i, song in enumerate(songs) if song == None]
 
-songs = match_transport(playlist, rb.get_songs(RB_DB))
+def compile_playlist(playlist, matcher, target):
+  """Match transport playlist with matcher and write the m3u to
+  target. Returns the list of error lines for songs not found."""
+  songs = matcher(playlist)
+  m3u_list = m3u.M3UList(songs, name=playlist['description'],
+                         comments=[playlist['comment']])
+  m3u.write(m3u_list, target)
+  return missing(playlist, songs)
 
-for i, song in enumerate(songs):
-  if song == None:
-    sys.stderr.write("E: couldn't find %d: %s by %s.\n" % 
-                     ((i+1), playlist["playlist"][i]["title"], 
-                      playlist["playlist"][i]["artist"]))
+def read_library(source):
+  "Read the Rhythmbox library source, with canonical titles and artists."
+  return with_keys(rb.get_songs(source))
 
-m3u_list = m3u.M3UList(songs, name=playlist['description'], 
-                       comments=[playlist['comment']])
+def rhythmbox_matcher(best=False, batch=False, window=LENGTH_WINDOW):
+  """Return a function matching a transport playlist against the
+  Rhythmbox library. The library is indexed up front for batches."""
+  library = snapshot.get_songs(RB_DB, RB_SNAPSHOT, read_library)
+  if batch:
+    library = SongIndex(library)
+  return lambda playlist: match_transport(playlist, library, best=best,
+                                          window=window)
 
-target = sys.stdout
+def xapian_matcher(dbpath, window=LENGTH_WINDOW):
+  """Return a function matching a transport playlist against the
+  xapian music database at dbpath."""
+  return lambda playlist: match_xapian(playlist, dbpath, window)
 
-if len(sys.argv) > 2:
-  target = sys.argv[2]
+def compile_one(source, target, matcher):
+  playlist = ts.load(source)
 
-m3u.write(m3u_list, target)
+  for error in compile_playlist(playlist, matcher, target):
+    sys.stderr.write("E: %s\n" % error)
 
-sys.stderr.write("N: Finished matching in %f seconds.\n" %
-                 (time.time() - start_time))
+def compile_batch(source_dir, target_dir, matcher):
+  """Compile every transport playlist (*.json) in source_dir to an
+  m3u file of the same name in target_dir with matcher. Unmatched
+  songs of all playlists are reported in target_dir/unmatched.txt."""
+  if not os.path.isdir(target_dir):
+    os.makedirs(target_dir)
 
+  report = []
+  sources = sorted(f for f in os.listdir(source_dir) if f.endswith(".json"))
+  for fn in sources:
+    target = os.path.join(target_dir, os.path.splitext(fn)[0] + ".m3u")
+    try:
+      playlist = ts.load(os.path.join(source_dir, fn))
+      if ts.valid_playlist(playlist):
+        errors = compile_playlist(playlist, matcher, target)
+      else:
+        errors = ["invalid transport playlist."]
+    except Exception as e:
+      # One broken playlist shouldn't stop the rest of the batch.
+      errors = [unicode(e)]
+    report.extend(u"%s: %s" % (fn, error) for error in errors)
 
+  with codecs.open(os.path.join(target_dir, REPORT_NAME), 'wb',
+                   encoding="utf-8") as report_file:
+    for line in report:
+      report_file.write(u"%s\n" % line)
+
+  sys.stderr.write("N: Compiled %d playlists, %d songs not found.\n" %
+                   (len(sources), len(report)))
+
+def main(args):
+  parser = argparse.ArgumentParser(
+    description="Compile transport playlists into m3u files.")
+  parser.add_argument("playlist", nargs="?",
+                      help="transport playlist to compile")
+  parser.add_argument("output", nargs="?",
+                      help="m3u file to write, or stdout if not given")
+  parser.add_argument("--batch", metavar="DIR",
+                      help="compile every transport playlist in DIR")
+  parser.add_argument("--out", metavar="DIR",
+                      help="write the m3u files of --batch to DIR")
+  parser.add_argument("--best", action="store_true",
+                      help="give each song to the entry it matches best "
+                      "instead of the first one it matches")
+  parser.add_argument("--xapian", metavar="DB",
+                      help="match against the xapian music database DB "
+                      "instead of the Rhythmbox library")
+  parser.add_argument("--window", metavar="SECONDS", type=int,
+                      default=LENGTH_WINDOW,
+                      help="only match songs within SECONDS of the playlist "
+                      "length (default %(default)s)")
+  parser.add_argument("--any-length", action="store_true",
+                      help="match songs of any length")
+  options = parser.parse_args(args[1:])
+
+  if options.batch:
+    if options.playlist or not options.out:
+      parser.error("--batch takes no playlist file and requires --out.")
+  elif not options.playlist or options.out:
+    parser.error("give either a playlist file or --batch and --out.")
+  if options.xapian and options.best:
+    parser.error("--best only applies to the Rhythmbox library.")
+
+  start_time = time.time()
+
+  window = None if options.any_length else options.window
+
+  if options.xapian:
+    matcher = xapian_matcher(options.xapian, window)
+  else:
+    # A batch reads and indexes the library only once.
+    matcher = rhythmbox_matcher(options.best, bool(options.batch), window)
+
+  if options.batch:
+    compile_batch(options.batch, options.out, matcher)
+  else:
+    compile_one(options.playlist, options.output or sys.stdout, matcher)
+
+  sys.stderr.write("N: Finished matching in %f seconds.\n" %
+                   (time.time() - start_time))
+
+if __name__ == "__main__":
+  main(sys.argv)
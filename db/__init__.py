@@ -1 +1,2 @@
-__all__ = ["dirtree", "rhythmbox", "xapian_music"]
+__all__ = ["columns", "dirtree", "fasttags", "rhythmbox", "snapshot",
+           "xapian_music"]
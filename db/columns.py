@@ -0,0 +1,130 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# A columnar in-memory view of a whole music database, for aggregate
+# questions (total length per artist, tracks per year...) that would
+# otherwise mean decoding every document. Needs NumPy.
+import numpy as np
+from db import xapian_music as xm
+
+# Numeric fields, stored as float arrays with NaN for missing values.
+NUMERIC_COLUMNS = ['year', 'length', 'rating', 'tracknumber',
+                   'mtime', 'lastplayed']
+
+# Text fields, dictionary encoded: an integer array of codes indexing
+# a list of distinct values, -1 for missing values.
+CATEGORY_COLUMNS = ['artist', 'album', 'genre']
+
+
+def _number(value, term):
+  if value is None or value == "":
+    return np.nan
+  try:
+    return xm.numeric_value(value, term)
+  except ValueError:
+    return np.nan
+
+
+class LibraryColumns(object):
+  """Columns of the songs in the database at dbpath. Numeric fields
+  are in self.numbers, dictionary encoded text fields in self.codes
+  and self.categories, and document ids and paths in self.ids and
+  self.paths, all in the same song order. The columns are rebuilt
+  from all_songs() whenever the database has changed on disk, which
+  every query checks first."""
+
+  def __init__(self, dbpath):
+    self.dbpath = dbpath
+    self.revision = None
+    self.refresh()
+
+  def refresh(self):
+    "Rebuild the columns if the database has changed since."
+    revision = xm.disk_revision(self.dbpath)
+    if revision == self.revision:
+      return
+    self.revision = revision
+
+    ids = []
+    self.paths = []
+    numbers = dict((term, []) for term in NUMERIC_COLUMNS)
+    codes = dict((term, []) for term in CATEGORY_COLUMNS)
+    lookup = dict((term, {}) for term in CATEGORY_COLUMNS)
+    self.categories = dict((term, []) for term in CATEGORY_COLUMNS)
+
+    for song in xm.all_songs(self.dbpath):
+      data = song['data']
+      ids.append(song['id'])
+      self.paths.append(data.get('path'))
+
+      for term in NUMERIC_COLUMNS:
+        numbers[term].append(_number(data.get(term), term))
+
+      for term in CATEGORY_COLUMNS:
+        value = data.get(term)
+        if value is None:
+          codes[term].append(-1)
+          continue
+        if value not in lookup[term]:
+          lookup[term][value] = len(self.categories[term])
+          self.categories[term].append(value)
+        codes[term].append(lookup[term][value])
+
+    self.ids = np.array(ids, dtype=np.uint32)
+    self.numbers = dict((term, np.array(numbers[term], dtype=np.float64))
+                        for term in NUMERIC_COLUMNS)
+    self.codes = dict((term, np.array(codes[term], dtype=np.int32))
+                      for term in CATEGORY_COLUMNS)
+
+  def __len__(self):
+    self.refresh()
+    return len(self.ids)
+
+  def where(self, term, low=None, high=None):
+    """Return a boolean mask of the songs whose numeric field term is
+    within [low, high]; songs without a value never are."""
+    self.refresh()
+    values = self.numbers[term]
+    mask = ~np.isnan(values)
+    # NaN compares false anyway, just not silently.
+    with np.errstate(invalid='ignore'):
+      if low is not None:
+        mask &= values >= low
+      if high is not None:
+        mask &= values <= high
+    return mask
+
+  def count_by(self, term, mask=None):
+    """Return a dictionary of the number of songs per value of the
+    field term, optionally only counting the songs in mask."""
+    self.refresh()
+    if term in self.codes:
+      codes = self.codes[term]
+      if mask is not None:
+        codes = codes[mask]
+      counts = np.bincount(codes[codes >= 0],
+                           minlength=len(self.categories[term]))
+      return dict((self.categories[term][i], int(count))
+                  for i, count in enumerate(counts) if count)
+
+    values = self.numbers[term]
+    if mask is not None:
+      values = values[mask]
+    values, counts = np.unique(values[~np.isnan(values)], return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+  def total_by(self, term, value_term, mask=None):
+    """Return a dictionary of the sum of the numeric field value_term
+    per value of the text field term, e.g. total_by('artist', 'length')
+    for the total length per artist. Missing values count as 0."""
+    self.refresh()
+    codes = self.codes[term]
+    values = np.nan_to_num(self.numbers[value_term])
+    if mask is not None:
+      codes = codes[mask]
+      values = values[mask]
+    known = codes >= 0
+    totals = np.bincount(codes[known], weights=values[known],
+                         minlength=len(self.categories[term]))
+    counts = np.bincount(codes[known], minlength=len(self.categories[term]))
+    return dict((self.categories[term][i], float(total))
+                for i, total in enumerate(totals) if counts[i])
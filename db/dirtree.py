@@ -2,6 +2,7 @@
 
 # FIXME: standardise naming conventions for functions.
 import codecs
+import collections
 from mutagen.flac import FLAC
 import mutagen
 from mutagen.mp3 import MP3
@@ -10,7 +11,11 @@ from mutagen.oggvorbis import OggVorbis
 from os import walk
 from os.path import join as pathjoin
 from os.path import getmtime
+from os.path import isfile
+import multiprocessing
 import time
+from db import fasttags
+from db import parallel
 
 
 class FileFormatError(Exception):
@@ -18,21 +23,107 @@ class FileFormatError(Exception):
   pass
 
 
-class SongData(dict):
-    """Basically a dictionary with authorised keys."""
+class SongData(object):
+    """Basically a dictionary with authorised keys. The fields are kept
+    in slots rather than a dictionary, to keep large libraries small in
+    memory, but can be used both as attributes and through the usual
+    (read and write) mapping methods, so str.format(**song) and the
+    like work. Fields outside of FIELDS are kept in a separate
+    dictionary."""
+
+    FIELDS = ('mtime', 'genre', 'lastplayed', 'rating', 'length',
+              'artist', 'title', 'year', 'tracknumber', 'album', 'path',
+              'tags')
+    # Every field but tags must be given.
+    REQUIRED = FIELDS[:-1]
+
+    __slots__ = FIELDS + ('_extra',)
+
     def __init__(self, *args, **kwargs):
-        self.mtime = kwargs['mtime']
-        self.genre = kwargs['genre']
-        self.lastplayed = kwargs['lastplayed']
-        self.rating = kwargs['rating']
-        self.length = kwargs['length']
-        self.artist = kwargs['artist']
-        self.title  = kwargs['title']
-        self.year = kwargs['year']
-        self.tracknumber = kwargs['tracknumber']
-        self.album = kwargs['album']
-        self.path = kwargs['path']
-        dict.__init__(self, *args, **kwargs)
+        fields = dict(*args, **kwargs)
+        for key in self.REQUIRED:
+            if key not in fields:
+                raise KeyError(key)
+
+        self._extra = None
+        for key, value in fields.iteritems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def keys(self):
+        return list(iter(self))
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "SongData(%r)" % dict(self.iteritems())
+
+    def __reduce__(self):
+        # Slots and no default constructor; pickle it as a dictionary.
+        return (SongData, (dict(self.iteritems()),))
+
+collections.Mapping.register(SongData)
 
 
 def read_metadata_from_file(af):
@@ -46,7 +137,18 @@ def read_metadata_from_file(af):
   else:
     raise FileFormatError("File type %s not supported for file: %s." % (extension, af))
 
+def read_tags(af):
+  """Read the tags and length of the music file af, only reading the
+  headers where possible and falling back on mutagen otherwise."""
+  try:
+    return fasttags.read(af)
+  except fasttags.UnsupportedFile:
+    return read_metadata_from_file(af)
+
 def get_files(p):
+  if isfile(p):
+    yield unicode(p, encoding="utf-8")
+    return
   for dirpath, _, files in walk(p):
     for f in files:
       # fixme: find out the actual encoding of the file system
@@ -58,7 +160,7 @@ def parseFile(filePath):
     # FIXME: return some kind of pre-defined object. Using a hashmap
     # for this is just silly.
     mtime = time.ctime(getmtime(filePath))
-    metadata = read_metadata_from_file(filePath)
+    metadata = read_tags(filePath)
     genre = metadata.get("genre", [None])[0]
     lastplayed = None
     rating = metadata.get("rating:banshee", [None])[0]
@@ -87,21 +189,48 @@ def parseFile(filePath):
                     rating=rating,
                     genre=genre)
 
-def get_songs(tree, prefilter=None, postfilter=None):
-    """Generator that returns a dictionary of metadata for a number of songs in that directory tree."""
-
-    for fl in get_files(tree):
-      mtime = time.ctime(getmtime(fl))
-
-      if prefilter:
-        if not prefilter(fl, mtime):
-          continue
-
-      try:
-          data = parseFile(fl)
-      except FileFormatError as e:
-        continue
-      except mutagen.flac.FLACNoHeaderError:
+def parse_song(filePath):
+    """parseFile, but returning None for files that aren't songs we
+    can read. Module level, so that worker processes can run it."""
+    try:
+        return parseFile(filePath)
+    except FileFormatError:
+        return None
+    except mutagen.flac.FLACNoHeaderError:
+        return None
+
+def get_songs(tree, prefilter=None, postfilter=None,
+              processes=None, ordered=True, inflight=None):
+    """Generator that returns a dictionary of metadata for a number of songs in that directory tree.
+
+    If processes is given, files are parsed by that many worker
+    processes, with at most inflight files (by default four per
+    process) being parsed at a time. If ordered is False, songs are
+    returned as soon as they are parsed rather than in directory
+    order. prefilter and postfilter are always run in this process."""
+
+    def candidates():
+      for fl in get_files(tree):
+        mtime = time.ctime(getmtime(fl))
+
+        if prefilter:
+          if not prefilter(fl, mtime):
+            continue
+
+        yield fl
+
+    if processes:
+      songs = _parse_in_pool(candidates(), processes, ordered,
+                             inflight or 4 * processes)
+    else:
+      songs = (parse_song(fl) for fl in candidates())
+
+    return _postfiltered(songs, postfilter)
+
+def _postfiltered(songs, postfilter):
+    "Drop unparseable songs and those postfilter doesn't like."
+    for data in songs:
+      if data is None:
         continue
 
       if postfilter:
@@ -109,3 +238,16 @@ def get_songs(tree, prefilter=None, postfilter=None):
           continue
 
       yield data
+
+def _parse_in_pool(files, processes, ordered, inflight):
+    "Generator parsing files with a pool of processes worker processes."
+    pool = multiprocessing.Pool(processes)
+    try:
+      for data in parallel.imap_bounded(pool, parse_song, files,
+                                        inflight, ordered):
+        yield data
+      pool.close()
+    finally:
+      # Stops the workers at once if we were interrupted or abandoned.
+      pool.terminate()
+      pool.join()
@@ -0,0 +1,368 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# A minimal tag reader that only reads the few header bytes holding
+# the tags and duration of a file, instead of having mutagen parse all
+# of it. Only the fields parseFile() uses are decoded; anything out of
+# the ordinary raises UnsupportedFile, and the caller is expected to
+# fall back on mutagen.
+import struct
+
+
+class UnsupportedFile(Exception):
+  "Thrown when a file can't be read without the full mutagen parser."
+  pass
+
+
+class StreamInfo(object):
+  "Stream information, like mutagen's, but only the length."
+  def __init__(self, length):
+    self.length = length
+
+
+class Tags(dict):
+  """Tags in the same shape as mutagen's file objects: lists of
+  unicode values by lower case field name, and the length of the
+  stream in info.length."""
+  def __init__(self, tags, length):
+    dict.__init__(self, tags)
+    self.info = StreamInfo(length)
+
+
+def read(path):
+  "Read the tags of the file at path. Raises UnsupportedFile."
+  extension = path.split(".")[-1]
+  if extension == "flac":
+    reader = read_flac
+  elif extension == "ogg":
+    reader = read_ogg_vorbis
+  elif extension == "mp3":
+    reader = read_mp3
+  else:
+    raise UnsupportedFile("Unknown file type %s." % extension)
+
+  with open(path, "rb") as f:
+    try:
+      return reader(f)
+    except (struct.error, IndexError, ValueError, ZeroDivisionError) as e:
+      raise UnsupportedFile("Damaged or unusual file %s: %s" % (path, e))
+
+def _read_exactly(f, size):
+  data = f.read(size)
+  if len(data) != size:
+    raise UnsupportedFile("Unexpected end of file.")
+  return data
+
+def parse_vorbis_comment(data):
+  """Parse a Vorbis comment block (the tags of both FLAC and Ogg
+  Vorbis files) into a dictionary of value lists."""
+  tags = {}
+  vendor_length, = struct.unpack_from("<I", data, 0)
+  offset = 4 + vendor_length
+  count, = struct.unpack_from("<I", data, offset)
+  offset += 4
+
+  for _ in xrange(count):
+    length, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    comment = data[offset:offset + length]
+    offset += length
+    if len(comment) != length:
+      raise UnsupportedFile("Truncated Vorbis comment.")
+
+    key, sep, value = comment.partition("=")
+    if not sep:
+      continue
+    tags.setdefault(key.decode("ascii").lower(), []).append(
+      value.decode("utf-8", "replace"))
+
+  return tags
+
+def read_flac(f):
+  "Read STREAMINFO and VORBIS_COMMENT from the FLAC file f."
+  if f.read(4) != "fLaC":
+    # Possibly an ID3 tag in front; leave that to mutagen.
+    raise UnsupportedFile("No FLAC header.")
+
+  length = None
+  tags = None
+  last = False
+  while not last and (length is None or tags is None):
+    header = _read_exactly(f, 4)
+    last = bool(ord(header[0]) & 0x80)
+    kind = ord(header[0]) & 0x7f
+    size, = struct.unpack(">I", "\0" + header[1:])
+
+    if kind == 0:
+      # STREAMINFO: 20 bits sample rate, 3 bits channels, 5 bits bits
+      # per sample and 36 bits total samples from byte 10 on.
+      fields, = struct.unpack_from(">Q", _read_exactly(f, size), 10)
+      sample_rate = fields >> 44
+      total_samples = fields & 0xFFFFFFFFF
+      if not sample_rate:
+        raise UnsupportedFile("No sample rate in STREAMINFO.")
+      length = total_samples / float(sample_rate)
+    elif kind == 4:
+      tags = parse_vorbis_comment(_read_exactly(f, size))
+    else:
+      f.seek(size, 1)
+
+  if length is None:
+    raise UnsupportedFile("No STREAMINFO block.")
+  return Tags(tags or {}, length)
+
+# Ogg page header: capture pattern, version, header type, granule
+# position, serial number, page sequence number, checksum and number
+# of segments.
+OGG_PAGE = struct.Struct("<4sBBqIIIB")
+
+def _ogg_packets(f, count):
+  """Return the first count packets of the first logical stream in
+  the Ogg file f, and the serial number of that stream."""
+  packets = []
+  packet = []
+  serial = None
+  while len(packets) < count:
+    magic, _, _, _, page_serial, _, _, segments = \
+        OGG_PAGE.unpack(_read_exactly(f, OGG_PAGE.size))
+    if magic != "OggS":
+      raise UnsupportedFile("Lost Ogg page sync.")
+    if serial is None:
+      serial = page_serial
+    elif page_serial != serial:
+      raise UnsupportedFile("Multiplexed Ogg stream.")
+
+    lacing = _read_exactly(f, segments)
+    body = _read_exactly(f, sum(ord(l) for l in lacing))
+    offset = 0
+    for l in lacing:
+      l = ord(l)
+      packet.append(body[offset:offset + l])
+      offset += l
+      if l < 255:
+        packets.append("".join(packet))
+        packet = []
+  return packets[:count], serial
+
+def _last_granule(f, serial):
+  """Return the granule position of the last page of the stream with
+  serial number serial, found in the tail of the Ogg file f."""
+  f.seek(0, 2)
+  size = f.tell()
+  f.seek(max(0, size - 65536))
+  tail = f.read()
+
+  index = tail.rfind("OggS")
+  while index >= 0:
+    if index + OGG_PAGE.size <= len(tail):
+      _, _, _, granule, page_serial, _, _, _ = \
+          OGG_PAGE.unpack_from(tail, index)
+      if page_serial == serial and granule != -1:
+        return granule
+    index = tail.rfind("OggS", 0, index)
+  raise UnsupportedFile("No last Ogg page found.")
+
+def read_ogg_vorbis(f):
+  """Read the identification and comment headers from the first
+  pages of the Ogg Vorbis file f, and the length from its last."""
+  (identification, comment), serial = _ogg_packets(f, 2)
+  if not identification.startswith("\x01vorbis"):
+    raise UnsupportedFile("Not an Ogg Vorbis stream.")
+  if not comment.startswith("\x03vorbis"):
+    raise UnsupportedFile("No Vorbis comment header.")
+
+  sample_rate, = struct.unpack_from("<I", identification, 12)
+  if not sample_rate:
+    raise UnsupportedFile("No sample rate in identification header.")
+
+  tags = parse_vorbis_comment(comment[7:])
+  return Tags(tags, _last_granule(f, serial) / float(sample_rate))
+
+# ID3v2 text frames and the EasyID3 keys they are read as.
+ID3_FRAMES = {"TIT2" : "title",
+              "TPE1" : "artist",
+              "TALB" : "album",
+              "TRCK" : "tracknumber",
+              "TCON" : "genre",
+              "TDRC" : "date",
+              "TYER" : "date"}
+
+ID3_ENCODINGS = ["latin-1", "utf-16", "utf-16-be", "utf-8"]
+
+def _syncsafe(data):
+  value = 0
+  for byte in data:
+    value = (value << 7) | (ord(byte) & 0x7f)
+  return value
+
+def _id3_text(data):
+  "Decode the values of an ID3v2 text frame."
+  text = data[1:].decode(ID3_ENCODINGS[ord(data[0])])
+  return [value.lstrip(u"\ufeff") for value in text.split(u"\0") if value]
+
+def _read_id3v2(f):
+  """Read an ID3v2.3 or 2.4 tag at the start of the file f, skipping
+  the frames we don't need (like embedded pictures) unread. Returns
+  the EasyID3 style tags and the offset of the first byte after the
+  tag."""
+  header = _read_exactly(f, 10)
+  if header[:3] != "ID3":
+    return {}, 0
+
+  major = ord(header[3])
+  flags = ord(header[5])
+  size = _syncsafe(header[6:10])
+  end = 10 + size + (10 if flags & 0x10 else 0)
+
+  if major not in (3, 4):
+    raise UnsupportedFile("ID3v2.%d tag." % major)
+  if flags & 0x80:
+    raise UnsupportedFile("Unsynchronised ID3v2 tag.")
+
+  if flags & 0x40:
+    # Skip the extended header.
+    extended = _read_exactly(f, 4)
+    if major == 4:
+      f.seek(_syncsafe(extended) - 4, 1)
+    else:
+      f.seek(struct.unpack(">I", extended)[0], 1)
+
+  tags = {}
+  while f.tell() + 10 <= 10 + size:
+    frame_header = _read_exactly(f, 10)
+    frame_id = frame_header[:4]
+    if frame_id == "\0\0\0\0":
+      # Padding
+      break
+    if not frame_id.isalnum():
+      raise UnsupportedFile("Broken ID3v2 frame header.")
+
+    if major == 4:
+      if any(ord(b) & 0x80 for b in frame_header[4:8]):
+        # Written by a tagger that got 2.4 frame sizes wrong.
+        raise UnsupportedFile("Frame size not synchsafe.")
+      frame_size = _syncsafe(frame_header[4:8])
+    else:
+      frame_size, = struct.unpack(">I", frame_header[4:8])
+    frame_flags, = struct.unpack(">H", frame_header[8:10])
+
+    if frame_id in ("TDAT", "TIME"):
+      # mutagen merges these into the date; let it.
+      raise UnsupportedFile("ID3v2.3 date spread over several frames.")
+    if frame_id not in ID3_FRAMES:
+      f.seek(frame_size, 1)
+      continue
+    # Compression, encryption, grouping and (2.4) unsynchronisation
+    # or data length indicators.
+    if frame_flags & (0x004F if major == 4 else 0x00E0):
+      raise UnsupportedFile("Encoded %s frame." % frame_id)
+
+    values = _id3_text(_read_exactly(f, frame_size))
+    if frame_id == "TCON":
+      for value in values:
+        if value.startswith(u"(") or value.isdigit():
+          # ID3v1 genre references; mutagen knows the names.
+          raise UnsupportedFile("Numeric genre %s." % value)
+    if values:
+      tags[ID3_FRAMES[frame_id]] = values
+
+  return tags, end
+
+MPEG_SAMPLE_RATES = {3 : [44100, 48000, 32000],  # MPEG 1
+                     2 : [22050, 24000, 16000],  # MPEG 2
+                     0 : [11025, 12000, 8000]}   # MPEG 2.5
+
+# Layer III bit rates in kbit/s by bit rate index.
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112,
+                  128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64,
+                  80, 96, 112, 128, 144, 160]
+
+def _mpeg_frame(header):
+  """Parse a four byte MPEG layer III frame header. Returns (version,
+  sample rate, bit rate, mono, frame length) or None if it isn't
+  one."""
+  if len(header) < 4:
+    return None
+  b1, b2, b3 = ord(header[1]), ord(header[2]), ord(header[3])
+  if ord(header[0]) != 0xFF or (b1 & 0xE0) != 0xE0:
+    return None
+  version = (b1 >> 3) & 3
+  layer = (b1 >> 1) & 3
+  bitrate_index = b2 >> 4
+  rate_index = (b2 >> 2) & 3
+  if version == 1 or layer != 1 or rate_index == 3 \
+        or bitrate_index in (0, 15):
+    return None
+
+  sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+  if version == 3:
+    bitrate = MPEG1_BITRATES[bitrate_index] * 1000
+    frame_length = 144 * bitrate // sample_rate + ((b2 >> 1) & 1)
+  else:
+    bitrate = MPEG2_BITRATES[bitrate_index] * 1000
+    frame_length = 72 * bitrate // sample_rate + ((b2 >> 1) & 1)
+  mono = (b3 >> 6) == 3
+  return version, sample_rate, bitrate, mono, frame_length
+
+def _mp3_length(f, start):
+  """Work out the length of the MP3 stream starting at byte start of
+  f, from a Xing or VBRI header if there is one, otherwise from its
+  bit rate and size."""
+  f.seek(0, 2)
+  size = f.tell()
+  f.seek(start)
+  data = f.read(16384)
+
+  # Find the first frame that is followed by another one.
+  index = data.find("\xFF")
+  while index >= 0:
+    frame = _mpeg_frame(data[index:index + 4])
+    if frame:
+      following = index + frame[4]
+      if _mpeg_frame(data[following:following + 4]):
+        break
+    index = data.find("\xFF", index + 1)
+  else:
+    raise UnsupportedFile("No MPEG audio frames found.")
+
+  version, sample_rate, bitrate, mono, _ = frame
+  samples_per_frame = 1152 if version == 3 else 576
+
+  if version == 3:
+    side_info = 17 if mono else 32
+  else:
+    side_info = 9 if mono else 17
+  xing = index + 4 + side_info
+
+  if data[xing:xing + 4] in ("Xing", "Info"):
+    flags, = struct.unpack_from(">I", data, xing + 4)
+    if flags & 1:
+      frames, = struct.unpack_from(">I", data, xing + 8)
+      samples = frames * samples_per_frame
+
+      # Skip the optional byte count, TOC and quality fields to get
+      # at the LAME tag and its encoder delay and padding.
+      lame = xing + 12 + (4 if flags & 2 else 0) \
+          + (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+      if data[lame:lame + 4] == "LAME":
+        delays = struct.unpack(">I", "\0" + data[lame + 21:lame + 24])[0]
+        samples -= (delays >> 12) + (delays & 0xFFF)
+
+      return max(samples, 0) / float(sample_rate)
+
+  vbri = index + 4 + 32
+  if data[vbri:vbri + 4] == "VBRI":
+    frames, = struct.unpack_from(">I", data, vbri + 14)
+    return frames * samples_per_frame / float(sample_rate)
+
+  # Constant bit rate; leave out any ID3v1 tag at the end.
+  if size >= 128:
+    f.seek(-128, 2)
+    if f.read(3) == "TAG":
+      size -= 128
+  return 8 * (size - start - index) / float(bitrate)
+
+def read_mp3(f):
+  "Read the ID3v2 tag and the length of the MP3 file f."
+  tags, end = _read_id3v2(f)
+  return Tags(tags, _mp3_length(f, end))
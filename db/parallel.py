@@ -0,0 +1,57 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Helpers for fanning work out over a pool of worker processes.
+from collections import deque
+from Queue import Queue
+
+
+class _Call(object):
+  """Picklable wrapper around func that always returns, reporting
+  exceptions as values so that they can be re-raised by the parent
+  (Pool.apply_async never calls back on errors)."""
+  def __init__(self, func):
+    self.func = func
+
+  def __call__(self, item):
+    try:
+      return True, self.func(item)
+    except Exception as e:
+      return False, e
+
+
+def _result(outcome):
+  ok, value = outcome
+  if not ok:
+    raise value
+  return value
+
+
+def imap_bounded(pool, func, iterable, inflight, ordered=True):
+  """Generator applying func to every item of iterable in the
+  multiprocessing pool pool, like pool.imap(). Unlike imap, at most
+  inflight items are read from iterable ahead of the results consumed,
+  so memory use stays flat however long the input is. Results come in
+  input order if ordered is True, otherwise as soon as they are
+  done. func must be picklable, i.e. defined at module level."""
+  call = _Call(func)
+
+  if ordered:
+    pending = deque()
+    for item in iterable:
+      pending.append(pool.apply_async(call, (item,)))
+      if len(pending) >= inflight:
+        yield _result(pending.popleft().get())
+    while pending:
+      yield _result(pending.popleft().get())
+  else:
+    done = Queue()
+    pending = 0
+    for item in iterable:
+      pool.apply_async(call, (item,), callback=done.put)
+      pending += 1
+      if pending >= inflight:
+        pending -= 1
+        yield _result(done.get())
+    while pending:
+      pending -= 1
+      yield _result(done.get())
@@ -4,28 +4,36 @@ from lxml import etree
 from urllib2 import unquote
 
 def get_songs(rb):
-    "Get all songs in a rhythmbox XML tree."
-    tree = etree.parse(rb)
-    root = tree.getroot()
-
-    tags = (element for element in root if element.get('type') == 'song')
-
-    for song in tags:
+    """Get all songs in a rhythmbox XML tree, as (title, artist,
+    location, duration) tuples. The duration is in seconds, or None if
+    Rhythmbox doesn't know it. The file is parsed incrementally, so
+    songs are yielded as soon as they are read and the whole tree is
+    never held in memory."""
+    for _, song in etree.iterparse(rb, events=('end',), tag='entry'):
         title = None
         artist = None
         location = None
+        duration = None
+
+        if song.get('type') == 'song':
+            for field in song:
+                if field.tag == 'title':
+                    title = unicode(field.text)
+                elif field.tag == 'artist':
+                    artist = unicode(field.text)
+                elif field.tag == 'location':
+                    location = unicode(unquote(field.text[7:]), encoding="utf-8")
+                elif field.tag == 'duration':
+                    # Not yet scanned songs have a duration of 0.
+                    duration = int(field.text) or None
+
+        # Throw away the entry and everything read before it, or the
+        # root element would still end up holding the entire database.
+        song.clear()
+        while song.getprevious() is not None:
+            del song.getparent()[0]
 
-        for field in song:
-            if field.tag == 'title':
-                title = unicode(field.text)
-            elif field.tag == 'artist':
-                artist = unicode(field.text)
-            elif field.tag == 'location':
-                location = unicode(unquote(field.text[7:]), encoding="utf-8")
-        
         song_data = (title, artist, location)
 
         if not None in song_data:
-            yield song_data
-        
-    
+            yield song_data + (duration,)
@@ -0,0 +1,124 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# On-disk snapshots of a song library, so that a slow source like the
+# Rhythmbox XML database only has to be parsed when it has changed.
+#
+# A snapshot is a fixed header followed by one column per song field.
+# Each column is the UTF-8 encoded field values separated by NUL
+# characters, which can't appear in XML text (or in file names).
+# Durations are stored as decimal text, empty where unknown. The last
+# two columns are the canonical title and artist used for matching
+# (see playlist.normalize), so they aren't recomputed on every run.
+import logging
+import os
+import struct
+
+MAGIC = "MTSS"
+VERSION = 3
+
+# magic, version, source mtime, source size, song count
+HEADER = struct.Struct("<4sIdQI")
+# Byte length of each of the columns that follow
+COLUMN_LENGTH = struct.Struct("<Q")
+
+# title, artist, location, duration, title key, artist key
+COLUMNS = 6
+DURATION = 3
+
+
+class SnapshotError(Exception):
+  "Thrown when a snapshot file is damaged or of an unknown version."
+  pass
+
+
+def source_stamp(source):
+  "Return the (mtime, size) pair a snapshot of source is keyed on."
+  st = os.stat(source)
+  return st.st_mtime, st.st_size
+
+def write(songs, fn, stamp):
+  """Write the (title, artist, location, duration, title key, artist
+  key) tuples in songs to a snapshot file fn, keyed on the (mtime,
+  size) pair stamp. The file is replaced atomically, so readers never
+  see a half-written snapshot."""
+  songs = list(songs)
+  columns = [u"\0".join(song[i] for song in songs).encode("utf-8")
+             if i != DURATION else
+             "\0".join("" if song[i] is None else str(song[i])
+                       for song in songs)
+             for i in xrange(COLUMNS)]
+
+  directory = os.path.dirname(fn)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  tmp = fn + ".tmp"
+  with open(tmp, "wb") as snap:
+    snap.write(HEADER.pack(MAGIC, VERSION, stamp[0], stamp[1], len(songs)))
+    for column in columns:
+      snap.write(COLUMN_LENGTH.pack(len(column)))
+    for column in columns:
+      snap.write(column)
+  os.rename(tmp, fn)
+
+def read(fn, stamp=None):
+  """Return the list of (title, artist, location, duration, title key,
+  artist key) tuples stored in the snapshot file fn, or None if it is missing or wasn't
+  made from a source with the (mtime, size) pair stamp."""
+  try:
+    snap = open(fn, "rb")
+  except IOError:
+    return None
+
+  with snap:
+    header = snap.read(HEADER.size + COLUMNS * COLUMN_LENGTH.size)
+    if len(header) != HEADER.size + COLUMNS * COLUMN_LENGTH.size:
+      raise SnapshotError("Truncated snapshot header in %s." % fn)
+
+    magic, version, mtime, size, count = HEADER.unpack_from(header)
+    if magic != MAGIC:
+      raise SnapshotError("%s is not a song snapshot." % fn)
+    if version != VERSION:
+      return None
+    if stamp is not None and (mtime, size) != tuple(stamp):
+      return None
+
+    if not count:
+      return []
+
+    columns = []
+    for i in xrange(COLUMNS):
+      length, = COLUMN_LENGTH.unpack_from(header,
+                                          HEADER.size + i * COLUMN_LENGTH.size)
+      column = snap.read(length).decode("utf-8").split(u"\0")
+      if len(column) != count:
+        raise SnapshotError("Damaged column %d in %s." % (i, fn))
+      columns.append(column)
+
+  columns[DURATION] = [int(duration) if duration else None
+                       for duration in columns[DURATION]]
+  return zip(*columns)
+
+def get_songs(source, fn, reader):
+  """Return the songs of the library file source as a list of
+  (title, artist, location, duration, title key, artist key) tuples.
+  They are read from the snapshot file fn if it is up to date,
+  otherwise they are read from source with reader (which must give
+  such tuples, e.g. playlist.normalize.with_keys over
+  rhythmbox.get_songs) and the snapshot is rebuilt."""
+  stamp = source_stamp(source)
+
+  try:
+    songs = read(fn, stamp)
+  except SnapshotError:
+    songs = None
+
+  if songs is None:
+    songs = list(reader(source))
+    try:
+      write(songs, fn, stamp)
+    except (IOError, OSError) as e:
+      # The snapshot is only a shortcut; we've got the songs anyway.
+      logging.warning("Couldn't write snapshot %s: %s" % (fn, e))
+
+  return songs
@@ -2,11 +2,20 @@
 # -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
 
 import xapian
+from array import array
+import collections
+from collections import OrderedDict
 from db.dirtree import get_songs
 import db.dirtree as dt
+from db import parallel
+from itertools import imap
 import json
+import marshal
+import multiprocessing
 import os
+import shutil
 import time
+import zlib
 #import hashlib
 import logging
 
@@ -23,28 +32,247 @@ PREFIXES = {'artist' : 'A',
 NUMERIC_PREFIXES = ['year', 'mtime', 'lastplayed',
                     'tracknumber', 'rating', 'length']
 
+# Fields that can be counted per value (see facets()). Each whole value
+# is a boolean term, the field's prefix, a colon and the value (which
+# word terms never start with), and is stored in a value slot after
+# the numeric ones.
+FACET_FIELDS = ['artist', 'album', 'genre']
+FACET_SLOTS = dict((term, len(NUMERIC_PREFIXES) + i)
+                   for i, term in enumerate(FACET_FIELDS))
+
+# Longer values don't fit in a term and aren't counted.
+MAX_FACET_TERM = 240
+
+# Number of documents to write per transaction when indexing.
+BATCH_SIZE = 1000
+
+# A sharded database is a directory with the shards, each a database
+# of its own, in this subdirectory (see index_sharded()).
+SHARD_DIR = 'shards'
+
+# The song fields stored in the binary document payload, in order.
+# Changing them means a new PAYLOAD_VERSION.
+PAYLOAD_FIELDS = ('path', 'title', 'artist', 'album', 'genre', 'year',
+                  'tracknumber', 'length', 'mtime', 'lastplayed',
+                  'rating', 'tags')
+PAYLOAD_VERSION = 1
+
+# Tags are boolean terms with this prefix, and the tags of a song are
+# whatever terms it has; the tags in the payload are only what it was
+# indexed with.
+TAG_PREFIX = 'K'
+
+# Number of matching document ids read at a time when tagging.
+TAG_CHUNK_SIZE = 1000
+
+# Number of songs per block handed to a worker when exporting.
+EXPORT_CHUNK_SIZE = 500
+
+# Number of best hits find_song() returns by default.
+FIND_LIMIT = 10
+
+# Number of parsed queries to keep around for repeated searches.
+QUERY_CACHE_SIZE = 128
+
+# Number of matches per page of paged search results.
+PAGE_SIZE = 50
+
+# Queries timed before and after compact(), each the best of
+# BENCHMARK_REPEAT runs: words, fields, ranges and tags.
+BENCHMARK_QUERIES = ['love', 'night OR day', 'artist:"the"',
+                     'year:1990..2000', 'genre:rock tag:favourite',
+                     'length:200..400']
+BENCHMARK_REPEAT = 5
+
+
+class SongMatch(object):
+    """A search hit, with the keys (and attributes) id, rank, percent
+    and data. Pass either the song data as data, or the xapian Document
+    as document, in which case data is only decoded when first used.
+    Uses slots rather than a dictionary to stay small."""
+
+    KEYS = ('id', 'rank', 'percent', 'data')
+
+    __slots__ = ('id', 'rank', 'percent', 'document', '_data')
 
-class SongMatch(dict):
     def __init__(self, **kwargs):
-        self.data = dt.SongData(**kwargs['data'])
         self.id = kwargs['id']
         self.rank = kwargs['rank']
         self.percent = kwargs['percent']
 
-        setDict = {'data' : self.data, 'id' : self.id,
-                   'rank' : self.rank, 'percent' : self.percent}
-        dict.__init__(self, **setDict)
+        if 'data' in kwargs:
+            self._data = dt.SongData(**kwargs['data'])
+            self.document = None
+        else:
+            self._data = None
+            self.document = kwargs['document']
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = dt.SongData(**document_song(self.document))
+            self.document = None
+        return self._data
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def __iter__(self):
+        return iter(self.KEYS)
 
+    def __len__(self):
+        return len(self.KEYS)
 
-def addSong(db, songData):
+    def keys(self):
+        return list(self.KEYS)
+
+    def get(self, key, default=None):
+        if key in self.KEYS:
+            return getattr(self, key)
+        return default
+
+collections.Mapping.register(SongMatch)
+
+
+class SearchPage(object):
+    """One page of search results: the SongMatch objects in matches,
+    the offset of the first of them, and an estimate of the total
+    number of matches."""
+    def __init__(self, matches, offset, estimate):
+        self.matches = matches
+        self.offset = offset
+        self.estimate = estimate
+
+
+def encode_song(songData):
+    """Encode songData as a binary document payload: a version byte,
+    then the marshalled values of PAYLOAD_FIELDS in order (so no keys
+    are stored) and a dictionary of any other fields, or None."""
+    values = tuple(songData.get(key) for key in PAYLOAD_FIELDS)
+    extra = dict((key, songData[key]) for key in songData
+                 if key not in PAYLOAD_FIELDS) or None
+    return chr(PAYLOAD_VERSION) + marshal.dumps((values, extra), 2)
+
+def decode_song(data):
+    """Decode a document payload into a dictionary of song data. Reads
+    both binary payloads and the JSON ones of older databases."""
+    if data[:1] == "{":
+        return json.loads(data)
+    if data[:1] != chr(PAYLOAD_VERSION):
+        raise ValueError("Unknown song payload version %r." % data[:1])
+
+    values, extra = marshal.loads(data[1:])
+    song = dict(zip(PAYLOAD_FIELDS, values))
+    if extra:
+        song.update(extra)
+    return song
+
+def tag_term(tag):
+    "Return the term of the tag tag."
+    if isinstance(tag, str):
+        tag = tag.decode("utf-8")
+    return (TAG_PREFIX + tag.lower()).encode("utf-8")
+
+def facet_prefix(facet):
+    "Return the prefix of the whole value terms of facet."
+    if facet == 'tag':
+        return TAG_PREFIX
+    return PREFIXES[facet] + ":"
+
+def document_tags(doc):
+    "Return the list of tags of the xapian Document doc."
+    tags = []
+    # Terms come in order, so the tags are all in one run.
+    for item in doc.termlist():
+        if item.term.startswith(TAG_PREFIX):
+            tags.append(item.term[len(TAG_PREFIX):].decode("utf-8"))
+        elif item.term > TAG_PREFIX:
+            break
+    return tags
+
+def document_song(doc):
+    """Return the song data of the xapian Document doc, with the tags
+    it actually has."""
+    song = decode_song(doc.get_data())
+    song['tags'] = document_tags(doc)
+    return song
+
+def migrate_payloads(dbpath, batch_size=BATCH_SIZE):
+    """Rewrite the JSON payloads of an older database at dbpath in the
+    binary format, batch_size documents per transaction, and give
+    songs the tag terms of the tags they were indexed with, which
+    older versions only stored in the payload. Run it once on such
+    databases. Returns the number of documents rewritten."""
+    shards = shard_dirs(dbpath)
+    if shards:
+        return sum(migrate_payloads(shard, batch_size) for shard in shards)
+
+    db = writable_database(dbpath)
+    count = 0
+    try:
+        # Don't iterate over the documents while changing them.
+        docids = [post.docid for post in db.postlist("")]
+        for docid in docids:
+            doc = db.get_document(docid)
+            data = doc.get_data()
+            song = decode_song(data)
+            missing = set(tag_term(tag) for tag in song.get('tags') or [])
+            missing.difference_update(tag_term(tag)
+                                      for tag in document_tags(doc))
+            if data[:1] != "{" and not missing:
+                continue
+            if count % batch_size == 0:
+                if count:
+                    db.commit_transaction()
+                db.begin_transaction()
+            if data[:1] == "{":
+                doc.set_data(encode_song(song))
+            for term in missing:
+                doc.add_boolean_term(term)
+            db.replace_document(docid, doc)
+            count += 1
+        if count:
+            db.commit_transaction()
+    finally:
+        db.close()
+    return count
+
+def make_term_generator():
+    "Return a TermGenerator set up the way songs are indexed."
+    termGenerator = xapian.TermGenerator()
+    termGenerator.set_stemmer(xapian.Stem("en"))
+    return termGenerator
+
+def add_values(doc, songData):
+    """Set the value slots of the xapian Document doc from songData,
+    and give it the terms of its facets."""
+    for data_slot, term in enumerate(NUMERIC_PREFIXES):
+        if songData.get(term):
+            doc.add_value(data_slot, make_value(songData[term], term))
+
+    for term in FACET_FIELDS:
+        if songData.get(term):
+            value = unicode(songData[term]).encode("utf-8")
+            doc.add_value(FACET_SLOTS[term], value)
+            facetTerm = facet_prefix(term) + value
+            if len(facetTerm) <= MAX_FACET_TERM:
+                doc.add_boolean_term(facetTerm)
+
+def addSong(db, songData, termGenerator=None):
     """Add a song with songData to the xapian WritableDatabase
     db. Performs no double-checking to see if file already exists, and
-    will overwrite data mercilessly."""
+    will overwrite data mercilessly. Pass a termGenerator from
+    make_term_generator() to reuse it between songs."""
     doc = xapian.Document()
 
     # Set up a TermGenerator that we'll use in indexing.
-    termGenerator = xapian.TermGenerator()
-    termGenerator.set_stemmer(xapian.Stem("en"))
+    if termGenerator is None:
+        termGenerator = make_term_generator()
     termGenerator.set_document(doc)
 
     # Index each field with a suitable prefix.
@@ -57,13 +285,13 @@ def addSong(db, songData):
         termGenerator.index_text(unicode(songData[term]))
         termGenerator.increase_termpos()
 
-    for data_slot, term in enumerate(NUMERIC_PREFIXES):
-        if songData[term]:
-            doc.add_value(data_slot, make_value(songData[term], term))
-
+    add_values(doc, songData)
 
     # Store all the fields for display purposes.
-    doc.set_data(unicode(json.dumps(songData)))
+    doc.set_data(encode_song(songData))
+
+    for tag in songData['tags'] or []:
+        doc.add_boolean_term(tag_term(tag))
 
     # We use the identifier to ensure each object ends up in the
     # database only once no matter how many times we run the
@@ -75,6 +303,75 @@ def addSong(db, songData):
     doc.add_boolean_term(idterm)
     db.replace_document(idterm, doc)
 
+class IndexSession(object):
+    """A session of writes to the xapian WritableDatabase db. Songs are
+    indexed with one shared TermGenerator, and changes are grouped into
+    transactions of batch_size documents. Use it in a with statement
+    (or call commit() when done); an exception cancels the changes of
+    the current batch."""
+
+    def __init__(self, db, batch_size=BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.termGenerator = make_term_generator()
+        self.pending = 0
+        self.count = 0
+        self.start_time = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.commit()
+            logging.info("Wrote %d documents in %f s (%f documents/s)."
+                         % (self.count, self.elapsed(), self.rate()))
+        elif self.pending:
+            self.db.cancel_transaction()
+            self.pending = 0
+
+    def _begin(self):
+        if not self.pending:
+            self.db.begin_transaction()
+
+    def _written(self):
+        self.pending += 1
+        self.count += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def add(self, songData):
+        "Add or replace the song songData, like addSong()."
+        self._begin()
+        addSong(self.db, songData, self.termGenerator)
+        self._written()
+
+    def replace(self, docid, doc):
+        "Replace the document docid with the xapian Document doc."
+        self._begin()
+        self.db.replace_document(docid, doc)
+        self._written()
+
+    def delete(self, path):
+        "Delete the song with the file path path."
+        self._begin()
+        self.db.delete_document("P" + path)
+        self._written()
+
+    def commit(self):
+        "Commit the current batch of changes, if any."
+        if self.pending:
+            self.db.commit_transaction()
+            self.pending = 0
+
+    def elapsed(self):
+        "Seconds since the session started."
+        return time.time() - self.start_time
+
+    def rate(self):
+        "Documents written per second so far."
+        return self.count / max(self.elapsed(), 1e-9)
+
 def mergeSongs(songA, songB):
     """Will merge the two song data sets. Data fields existing in any
     of the songs will be kept in the final product. Left fields will
@@ -101,105 +398,565 @@ def mergeSongs(songA, songB):
 def pathInDB(db, path):
     """Returns True if a song with path exists in the xapian database
     db, False otherwise."""
-    enquire = xapian.Enquire(db)
-    enquire.set_query(parse_query("path:" + path))
-    enquire.set_docid_order(enquire.DONT_CARE)
-    return bool(enquire.get_mset(0, db.get_doccount()))
+    return db.term_exists("P" + path)
 
-def make_value(s, term):
+def read_manifest(db):
+    """Return a dictionary mapping the path of every song in the xapian
+    database db to a tuple (mtime, docid), mtime being the modification
+    time of the file when it was indexed, in seconds since the epoch.
+    Only the P id terms and the mtime value slot are read."""
+    slot = NUMERIC_PREFIXES.index('mtime')
+    mtimes = dict((value.docid, xapian.sortable_unserialise(value.value))
+                  for value in db.valuestream(slot))
+
+    manifest = dict()
+    for term in db.allterms("P"):
+        path = term.term[1:].decode("utf-8")
+        for post in db.postlist(term.term):
+            manifest[path] = (mtimes.get(post.docid, 0), post.docid)
+    return manifest
+
+def numeric_value(s, term):
     """Parse various string values and return suitable numeric
     representations."""
     if term == 'year':
         # This is in a date string format due to serialization.
-        return xapian.sortable_serialise(int(s))
+        return int(s)
     if term == 'mtime':
-        return xapian.sortable_serialise(time.mktime(time.strptime(s)))
+        return time.mktime(time.strptime(s))
     if term == 'rating':
-        return xapian.sortable_serialise(float(s))
+        return float(s)
     else:
-        return xapian.sortable_serialise(int(s))
+        return int(s)
+
+def shard_dirs(dbpath):
+    """Return the paths of the shards of the database at dbpath, in
+    order, or an empty list if it isn't sharded."""
+    shards = os.path.join(dbpath, SHARD_DIR)
+    if not os.path.isdir(shards):
+        return []
+    return [os.path.join(shards, name) for name in sorted(os.listdir(shards))
+            if not name.startswith(".")]
+
+def open_database(dbpath):
+    """Open the database at dbpath for reading. The shards of a sharded
+    database are opened as one database."""
+    shards = shard_dirs(dbpath)
+    if not shards:
+        return xapian.Database(dbpath)
+    db = xapian.Database()
+    for shard in shards:
+        db.add_database(xapian.Database(shard))
+    return db
 
-def index(datapath, dbpath):
+def writable_database(dbpath):
+    """Create or open the database at dbpath for writing. Sharded
+    databases are only written to by index_sharded()."""
+    if shard_dirs(dbpath):
+        raise Exception("%s is a sharded database, reindex it with "
+                        "index_sharded()." % dbpath)
+    return xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN)
+
+def make_value(s, term):
+    """Parse various string values and return them serialised for a
+    value slot."""
+    return xapian.sortable_serialise(numeric_value(s, term))
+
+def index(datapath, dbpath, processes=None, batch_size=BATCH_SIZE,
+          roots=None):
     """Create or update the index stored in database <dbpath>, using
-    the music file/directory structure in <datapath>."""
+    the music file/directory structure in <datapath>. Only files that
+    are new or have changed since they were indexed are parsed; with
+    processes, they are parsed by that many worker processes. Changes
+    are committed batch_size documents at a time. With roots, only the
+    files and directories in roots (under datapath) are indexed, and
+    songs anywhere else are deleted."""
+    # An unmounted music directory would look like every song had
+    # disappeared.
+    if not os.path.isdir(datapath):
+        raise IOError("Music directory %s not found." % datapath)
+
     # Create or open the database we're going to be writing to.
-    db = xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN)
+    db = writable_database(dbpath)
 
-    # Make sure all songs in the directory are in the database.
-    for filePath in dt.get_files(datapath):
-        if not pathInDB(db, filePath):
-            addSong(db, dt.parseFile(filePath))
-        else:
-            mtimeFile = os.path.getmtime(filePath)
-            dbEntry = search(dbpath, "path:" + filePath)[0]
-            mtimeDB = time.mktime(time.strptime(dbEntry['data']['mtime']))
-            if mtimeFile > mtimeDB:
-                logging.warning("File %s has changed." % filePath)
-                addSong(db, mergeSongs(dbEntry['data'], dt.parseFile(filePath)))
+    # What we already know, so that we don't have to ask the database
+    # about every single file.
+    manifest = read_manifest(db)
+    # Every file found in the directory, parsed or not.
+    seen = set()
+
+    def changed(filePath, mtime):
+        seen.add(filePath)
+        if filePath not in manifest:
+            return True
+        if time.mktime(time.strptime(mtime)) > manifest[filePath][0]:
+            logging.warning("File %s has changed." % filePath)
+            return True
+        logging.info("File %s hasn't changed." % filePath)
+        return False
+
+    with IndexSession(db, batch_size) as session:
+        # Make sure all songs in the directory are in the database.
+        for root in ([datapath] if roots is None else roots):
+            for song in dt.get_songs(root, prefilter=changed,
+                                     processes=processes):
+                if song.path in manifest:
+                    refreshSong(session, song, manifest[song.path][1])
+                else:
+                    session.add(song)
+
+        # Now, make sure no songs have disappeared.
+        for songPath in manifest:
+            if songPath not in seen:
+                logging.warning("Song file %s has disappeared!" % songPath)
+                session.delete(songPath)
+
+    db.close()
+
+def refreshSong(session, song, docid):
+    """Replace the document docid with the newly parsed song through
+    the IndexSession session, keeping what we knew about it."""
+    dbEntry = document_song(session.db.get_document(docid))
+    # The merge keeps what we knew, except for the new mtime, or the
+    # file would look changed forever.
+    dbEntry['mtime'] = song['mtime']
+    session.add(mergeSongs(dbEntry, song))
+
+def update(dbpath, paths, batch_size=BATCH_SIZE):
+    """Bring the songs of the files and directories in paths up to
+    date in the index at dbpath, without walking anything else: the
+    songs of those that exist are (re)indexed, and those that are gone
+    (and everything that was under them) are deleted. For keeping the
+    index live as files change, see bin/fredd.py."""
+    db = writable_database(dbpath)
+
+    with IndexSession(db, batch_size) as session:
+        for path in paths:
+            if isinstance(path, str):
+                path = path.decode("utf-8")
+
+            if os.path.isdir(path):
+                files = dt.get_files(path.encode("utf-8"))
+            elif os.path.exists(path):
+                files = [path]
             else:
-                logging.info("File %s hasn't changed." % filePath)
+                # Whatever was at or under path has disappeared.
+                prefix = ("P" + path).encode("utf-8")
+                gone = [term.term for term in db.allterms(prefix)
+                        if term.term == prefix or
+                        term.term.startswith(prefix + "/")]
+                for term in gone:
+                    logging.warning("Song file %s has disappeared!"
+                                    % term[1:].decode("utf-8"))
+                    session.delete(term[1:].decode("utf-8"))
+                continue
+
+            for filePath in files:
+                song = dt.parse_song(filePath)
+                if song is None:
+                    continue
+                docids = [post.docid for post in db.postlist("P" + filePath)]
+                if docids:
+                    refreshSong(session, song, docids[0])
+                else:
+                    session.add(song)
+
+    db.close()
+
+def shard_of(name, shards):
+    "Return the number of the shard the top-level entry name goes in."
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    # Not hash(), which isn't the same everywhere.
+    return (zlib.crc32(name) & 0xffffffff) % shards
+
+def _index_shard(job):
+    """Index the roots of one shard, as (datapath, shard path, roots,
+    batch size). Module level, so that worker processes can run it."""
+    datapath, shard, roots, batch_size = job
+    index(datapath, shard, batch_size=batch_size, roots=roots)
+    return shard
+
+def index_sharded(datapath, dbpath, shards=None, batch_size=BATCH_SIZE,
+                  compact_to=None):
+    """Create or update the sharded index at <dbpath> of <datapath>,
+    like index(). The top-level files and directories of datapath are
+    spread over shards (by default, as many as there are CPUs) by the
+    hash of their names, and every shard is indexed by a worker
+    process of its own. Searching dbpath searches all of them. The
+    number of shards of an existing index can't be changed. With
+    compact_to, the shards are then also compacted into a single
+    database at that path (see compact_database())."""
+    if not os.path.isdir(datapath):
+        raise IOError("Music directory %s not found." % datapath)
+
+    existing = shard_dirs(dbpath)
+    if existing and shards and shards != len(existing):
+        raise Exception("%s has %d shards, not %d." %
+                        (dbpath, len(existing), shards))
+    shards = len(existing) or shards or multiprocessing.cpu_count()
+
+    roots = [[] for i in range(shards)]
+    for name in sorted(os.listdir(datapath)):
+        roots[shard_of(name, shards)].append(os.path.join(datapath, name))
+
+    shardpath = os.path.join(dbpath, SHARD_DIR)
+    if not os.path.isdir(shardpath):
+        os.makedirs(shardpath)
+    jobs = [(datapath, os.path.join(shardpath, "%03d" % i), roots[i],
+             batch_size) for i in range(shards)]
+
+    pool = multiprocessing.Pool(shards)
+    try:
+        for shard in pool.imap_unordered(_index_shard, jobs):
+            logging.info("Indexed shard %s." % shard)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if compact_to:
+        compact_database(dbpath, compact_to)
+
+def compact_database(dbpath, target):
+    """Write the database at dbpath, sharded or not, compacted into a
+    single database at target, which is replaced once it is done."""
+    db = open_database(dbpath)
+    # Hidden, so that they are never taken for shards.
+    head, name = os.path.split(target.rstrip(os.sep))
+    temp = os.path.join(head, "." + name + ".new")
+    old = os.path.join(head, "." + name + ".old")
+    if os.path.exists(temp):
+        shutil.rmtree(temp)
+    try:
+        db.compact(temp)
+    finally:
+        db.close()
+
+    if os.path.exists(target):
+        os.rename(target, old)
+    os.rename(temp, target)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+def database_size(dbpath):
+    "Return the number of bytes taken by the database at dbpath."
+    size = 0
+    for dirpath, _, files in os.walk(dbpath):
+        for name in files:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+def rebuild_values(db, batch_size=BATCH_SIZE):
+    """Set the value slots of every document in the xapian
+    WritableDatabase db anew from its payload, batch_size documents
+    per transaction. Returns the number of documents rewritten."""
+    with IndexSession(db, batch_size) as session:
+        # Don't iterate over the documents while changing them.
+        docids = array('I', (post.docid for post in db.postlist("")))
+        for docid in docids:
+            doc = db.get_document(docid)
+            doc.clear_values()
+            add_values(doc, decode_song(doc.get_data()))
+            session.replace(docid, doc)
+    return len(docids)
+
+def benchmark(dbpath, queries=BENCHMARK_QUERIES, repeat=BENCHMARK_REPEAT):
+    """Return the seconds it takes to get the first page of matches of
+    each of queries from the database at dbpath, the best of repeat
+    runs each, on a freshly opened database."""
+    searcher = Searcher(dbpath)
+    timings = []
+    try:
+        for querystring in queries:
+            best = None
+            for i in range(repeat):
+                start_time = time.time()
+                searcher.query(querystring, limit=PAGE_SIZE)
+                elapsed = time.time() - start_time
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings.append(best)
+    finally:
+        searcher.db.close()
+    return timings
+
+def compact(dbpath, queries=BENCHMARK_QUERIES, batch_size=BATCH_SIZE):
+    """Rebuild the value slots of every song in the database at dbpath
+    and compact it in place (each shard of a sharded database on its
+    own), for the fragmentation that rewriting documents leaves
+    behind. Returns a dictionary of the number of documents, the
+    sizes in bytes before and after, and (query, seconds before,
+    seconds after) for each of queries, as timed by benchmark()."""
+    before = benchmark(dbpath, queries)
+    report = {'documents' : 0, 'size' : (database_size(dbpath), None)}
+
+    for path in shard_dirs(dbpath) or [dbpath]:
+        # Keep out other writers until the compacted copy has replaced
+        # the database, or their changes would be lost.
+        db = writable_database(path)
+        try:
+            report['documents'] += rebuild_values(db, batch_size)
+            compact_database(path, path)
+        finally:
+            db.close()
+
+    # Searchers of the old files would have to start over anyway.
+    _searchers.pop(os.path.realpath(dbpath), None)
+
+    report['size'] = (report['size'][0], database_size(dbpath))
+    report['latency'] = zip(queries, before, benchmark(dbpath, queries))
+    return report
+
+class QueryParser(object):
+    """A QueryParser set up with our stemmer, prefixes and value
+    ranges, keeping the last cache_size parsed queries around."""
+
+    def __init__(self, cache_size=QUERY_CACHE_SIZE):
+        self.queryparser = xapian.QueryParser()
+        self.queryparser.set_stemmer(xapian.Stem("en"))
+        self.queryparser.set_stemming_strategy(self.queryparser.STEM_SOME)
+
+        self.queryparser.add_boolean_prefix("tag", "K")
+
+        for term in PREFIXES:
+            self.queryparser.add_prefix(term, PREFIXES[term])
+
+        # The QueryParser doesn't keep its range processors alive.
+        self.rangeProcessors = []
+        for data_slot, term in enumerate(NUMERIC_PREFIXES):
+            processor = xapian.NumberValueRangeProcessor(data_slot, term, True)
+            self.queryparser.add_valuerangeprocessor(processor)
+            self.rangeProcessors.append(processor)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def parse_query(self, q):
+        "Parse the query string q, or get it from the cache."
+        try:
+            query = self.cache.pop(q)
+        except KeyError:
+            query = self.queryparser.parse_query(q)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        # (Re-)insert as the most recently used.
+        self.cache[q] = query
+        return query
+
+    def parse_field(self, text, term):
+        """Parse the plain text text (e.g. a song title, not a query
+        string) as words of the field term."""
+        # No flags: operators and quotes are just part of the text.
+        return self.queryparser.parse_query(text, 0, PREFIXES[term])
 
-    # Now, make sure no songs have disappeared.
-    songFiles = dt.get_files(datapath)
-    for song in all_songs(dbpath):
-        songPath = song['data']['path']
-        if not songPath in songFiles:
-            logging.warning("Song file %s has disappeared!" % songPath)
-            # do some voodoo to delete the entry here.
+_queryparser = None
 
 def parse_query(q):
     """Parse the query <q> and return a query ready for use with
     enquire.set_query()."""
+    global _queryparser
+    if _queryparser is None:
+        _queryparser = QueryParser()
+    return _queryparser.parse_query(q)
 
-    # Set up a QueryParser with a stemmer and suitable prefixes
-    queryparser = xapian.QueryParser()
-    queryparser.set_stemmer(xapian.Stem("en"))
-    queryparser.set_stemming_strategy(queryparser.STEM_SOME)
+def disk_revision(dbpath):
+    """Return something that changes whenever the database at dbpath is
+    written to, without opening it: the names, sizes and modification
+    times of its files."""
+    revision = []
+    for name in sorted(os.listdir(dbpath)):
+        path = os.path.join(dbpath, name)
+        if os.path.isdir(path):
+            # The shards of a sharded database.
+            revision.append((name, disk_revision(path)))
+            continue
+        st = os.stat(path)
+        revision.append((name, st.st_size, st.st_mtime))
+    return revision
 
-    queryparser.add_boolean_prefix("tag", "K")
 
-    for term in PREFIXES:
-        queryparser.add_prefix(term, PREFIXES[term])
+class Searcher(object):
+    """A long-lived handle for searching the database at dbpath. The
+    database is kept open, and only reopened when it has changed on
+    disk; queries are parsed with a cached QueryParser."""
 
-    for data_slot, term in enumerate(NUMERIC_PREFIXES):
-        queryparser.add_valuerangeprocessor(
-            xapian.NumberValueRangeProcessor(data_slot, term, True)
-        )
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.revision = disk_revision(dbpath)
+        self.shards = shard_dirs(dbpath)
+        self.db = open_database(dbpath)
+        self.queryparser = QueryParser()
 
-    # And parse the query
-    return queryparser.parse_query(q)
+    def refresh(self):
+        "Reopen the database if it has been written to since."
+        revision = disk_revision(self.dbpath)
+        if revision != self.revision:
+            shards = shard_dirs(self.dbpath)
+            if shards != self.shards:
+                self.db = open_database(self.dbpath)
+                self.shards = shards
+            else:
+                self.db.reopen()
+            self.revision = revision
 
-def query(dbpath, querystring, order=None):
-    """Query the database at path <dbpath> with the string
-    <querystring>. Return iterator over maches. This is mostly for
-    internal use, as it returns xapian match objects. Optionally takes
-    the argument order with valid values None or any numeric term."""
+    def get_mset(self, enquire, first, maxitems, checkatleast=0):
+        """enquire.get_mset, retrying once on a fresh revision if a
+        writer has changed the database under our feet."""
+        try:
+            return enquire.get_mset(first, maxitems, checkatleast)
+        except xapian.DatabaseModifiedError:
+            self.db.reopen()
+            self.revision = disk_revision(self.dbpath)
+            return enquire.get_mset(first, maxitems, checkatleast)
+
+    def query(self, querystring, order=None, offset=0, limit=None):
+        """Query the database with the string <querystring>, like
+        query(). Returns the xapian MSet of limit matches (by default
+        all of them) from offset on."""
+        self.refresh()
+
+        # Use an Enquire object on the database to run the query
+        enquire = xapian.Enquire(self.db)
+        enquire.set_query(self.queryparser.parse_query(querystring))
+
+        # Don't care about document ID order, just optimize.
+        enquire.set_docid_order(enquire.DONT_CARE)
+
+        if order in NUMERIC_PREFIXES:
+            slot_id = NUMERIC_PREFIXES.index(order)
+            enquire.set_sort_by_value_then_relevance(slot_id, False)
+
+        if limit is None:
+            limit = self.db.get_doccount()
+        return self.get_mset(enquire, offset, limit)
+
+    def search(self, querystring, order=None, offset=0, limit=None):
+        "Search the database with querystring, like search()."
+        return [SongMatch(id=match.docid, rank=(match.rank + 1),
+                          percent=match.percent, document=match.document)
+                for match in self.query(querystring, order, offset, limit)]
+
+    def search_page(self, querystring, offset=0, limit=PAGE_SIZE, order=None):
+        "Return a SearchPage of limit matches from offset on."
+        mset = self.query(querystring, order, offset, limit)
+        matches = [SongMatch(id=match.docid, rank=(match.rank + 1),
+                             percent=match.percent, document=match.document)
+                   for match in mset]
+        return SearchPage(matches, offset, mset.get_matches_estimated())
+
+    def find_song(self, title, artist, length=None, window=None,
+                  limit=FIND_LIMIT):
+        """Return a list of at most limit SongMatch objects of the songs
+        best matching title and artist, title counting the most. With
+        length and window, only songs within window seconds of length
+        are considered."""
+        self.refresh()
+
+        songQuery = xapian.Query(xapian.Query.OP_OR,
+          xapian.Query(xapian.Query.OP_SCALE_WEIGHT,
+                       self.queryparser.parse_field(title, 'title'), 2),
+          self.queryparser.parse_field(artist, 'artist'))
+
+        if length is not None and window is not None:
+            lengthRange = xapian.Query(xapian.Query.OP_VALUE_RANGE,
+              NUMERIC_PREFIXES.index('length'),
+              xapian.sortable_serialise(max(length - window, 0)),
+              xapian.sortable_serialise(length + window))
+            songQuery = xapian.Query(xapian.Query.OP_FILTER,
+                                     songQuery, lengthRange)
+
+        enquire = xapian.Enquire(self.db)
+        enquire.set_query(songQuery)
+        return [SongMatch(id=match.docid, rank=(match.rank + 1),
+                          percent=match.percent, document=match.document)
+                for match in self.get_mset(enquire, 0, limit)]
+
+    def facet(self, facet, querystring=None):
+        """Return a dictionary of the number of songs per value of
+        facet ('tag' or one of FACET_FIELDS), counting only the songs
+        matching querystring if given."""
+        self.refresh()
+        prefix = facet_prefix(facet)
+
+        if querystring is None:
+            # Straight from the term statistics.
+            return dict((item.term[len(prefix):].decode("utf-8"),
+                         item.termfreq)
+                        for item in self.db.allterms(prefix))
 
-    # Open the database we're going to search.
-    db = xapian.Database(dbpath)
+        query = self.queryparser.parse_query(querystring)
+        everything = self.db.get_doccount()
+        enquire = xapian.Enquire(self.db)
+        enquire.set_weighting_scheme(xapian.BoolWeight())
 
-    # Use an Enquire object on the database to run the query
-    enquire = xapian.Enquire(db)
-    enquire.set_query(parse_query(querystring))
+        if facet == 'tag':
+            # Songs have any number of tags, so they can't be counted
+            # from a value slot; count the matches of each tag instead.
+            counts = dict()
+            for item in self.db.allterms(prefix):
+                enquire.set_query(xapian.Query(xapian.Query.OP_FILTER, query,
+                                               xapian.Query(item.term)))
+                count = self.get_mset(enquire, 0, 0, everything) \
+                    .get_matches_estimated()
+                if count:
+                    counts[item.term[len(prefix):].decode("utf-8")] = count
+            return counts
 
-    # Don't care about document ID order, just optimize.
-    enquire.set_docid_order(enquire.DONT_CARE)
+        spy = xapian.ValueCountMatchSpy(FACET_SLOTS[facet])
+        enquire.set_query(query)
+        enquire.add_matchspy(spy)
+        # No matches wanted, but every one of them looked at.
+        self.get_mset(enquire, 0, 0, everything)
+        return dict((item.term.decode("utf-8"), item.termfreq)
+                    for item in spy.values())
 
-    if order in NUMERIC_PREFIXES:
-        slot_id = NUMERIC_PREFIXES.index(order)
-        enquire.set_sort_by_value_then_relevance(slot_id, False)
+# Searchers by database path, for the module level search functions.
+_searchers = dict()
 
-    for match in enquire.get_mset(0, db.get_doccount()):
+def get_searcher(dbpath):
+    "Return the shared Searcher of the database at dbpath."
+    key = os.path.realpath(dbpath)
+    if key not in _searchers:
+        _searchers[key] = Searcher(dbpath)
+    return _searchers[key]
+
+def query(dbpath, querystring, order=None, offset=0, limit=None):
+    """Query the database at path <dbpath> with the string
+    <querystring>. Return iterator over maches. This is mostly for
+    internal use, as it returns xapian match objects. Optionally takes
+    the argument order with valid values None or any numeric term, and
+    offset and limit to only get a part of the matches."""
+    for match in get_searcher(dbpath).query(querystring, order,
+                                            offset, limit):
         yield match
 
-def search(dbpath, querystring, order=None):
+def search(dbpath, querystring, order=None, offset=0, limit=None):
     """Search the database at dbpath with querystring. Return list of
-    SongMatch object."""
+    SongMatch object, of at most limit matches from offset on."""
+    return get_searcher(dbpath).search(querystring, order, offset, limit)
+
+def search_page(dbpath, querystring, offset=0, limit=PAGE_SIZE, order=None):
+    """Search the database at dbpath with querystring. Return a
+    SearchPage of at most limit matches from offset on."""
+    return get_searcher(dbpath).search_page(querystring, offset,
+                                            limit, order)
 
-    return [SongMatch(id=match.docid, rank=(match.rank + 1),
-                      percent=match.percent,
-                      data=(json.loads(unicode(match.document.get_data()))))
-            for match in query(dbpath, querystring, order)]
+def find_song(dbpath, title, artist, length=None, window=None,
+              limit=FIND_LIMIT):
+    """Return a list of at most limit SongMatch objects of the songs in
+    the database at dbpath best matching title and artist, optionally
+    only those within window seconds of length."""
+    return get_searcher(dbpath).find_song(title, artist, length,
+                                          window, limit)
+
+def facets(dbpath, querystring=None, names=['tag'] + FACET_FIELDS):
+    """Return a dictionary of the song counts per value of each facet
+    in names (see Searcher.facet), of all songs in the database at
+    dbpath or only of those matching querystring, e.g.
+    facets(db)['genre'][u"EBM"]."""
+    searcher = get_searcher(dbpath)
+    return dict((name, searcher.facet(name, querystring)) for name in names)
 
 def parseTags(tagString):
     """Parse the tags in tagString, returning a tuple of tags to add
@@ -214,47 +971,70 @@ def parseTags(tagString):
             add.append(tag)
     return add, remove
 
-def tag(dbPath, queryString, tagString):
-    "Add and remove tags (in one transaction) to the db att dbPath."
+def tag(dbPath, queryString, tagString, chunk_size=TAG_CHUNK_SIZE):
+    """Add and remove tags (in one transaction) to the songs matching
+    queryString in the db at dbPath. tagString is as for parseTags().
+    Only the tag terms of the songs are changed, so neither their
+    data nor the rest of their postings are rewritten. Returns the
+    number of songs changed. The shards of a sharded database are
+    tagged one at a time."""
+    shards = shard_dirs(dbPath)
+    if shards:
+        return sum(tag(shard, queryString, tagString, chunk_size)
+                   for shard in shards)
 
     addTags, removeTags = parseTags(tagString)
-    # This is a list of touples with document ID and Document objects
-    # to modify.
-    docsModify = []
+    addTerms = [tag_term(t) for t in addTags]
+    removeTerms = [tag_term(t) for t in removeTags]
 
+    # Opening the database for writing locks it, so the matches can't
+    # change between finding and tagging them. It is the
+    # responsibility of the client/higher level interface to handle
+    # queuing of database writes.
+    db = writable_database(dbPath)
     try:
-        db = xapian.WritableDatabase(dbPath, xapian.DB_CREATE_OR_OPEN)
-        # We open the database this early because it will lock the
-        # database for writing, making sure our fetched documents
-        # doesn't change during the processing, making us overwrite
-        # changes at the last step.
-
-        # It is the responsibility of the client/higher level
-        # interface to handle queuing of database writes.
-        for match in query(dbPath, queryString):
-            doc = match.document
-            data = json.loads(doc.get_data())
-            # Remove the tags to remove:
-            newTags = filter(lambda t: not t in removeTags, data['tags'])
-            #...and add the tags to add:
-            newTags = newTags + addTags
-            data['tags'] = newTags
-        
-            for tag in removeTags:
-                doc.remove_term('K' + tag.lower())
-            for tag in addTags:
-                doc.add_boolean_term('K' + tag.lower())
-
-            doc.set_data(unicode(json.dumps(data)))
-            docsModify.append((match.docid, doc))
-
-        # This is done finally to avoid half-completed
-        # transactions. Either all documents matching the search
-        # should be given all the specified tags, or none.
-        for docId, doc in docsModify:
-            db.replace_document(docId, doc)
+        enquire = xapian.Enquire(db)
+        enquire.set_query(parse_query(queryString))
+        enquire.set_weighting_scheme(xapian.BoolWeight())
+        enquire.set_docid_order(enquire.ASCENDING)
+
+        # Only the document ids, chunk_size at a time. They are all
+        # found before anything changes, or tagging could move songs
+        # in or out of the matches we are paging through.
+        docids = array('I')
+        while True:
+            mset = enquire.get_mset(len(docids), chunk_size)
+            docids.extend(match.docid for match in mset)
+            if mset.size() < chunk_size:
+                break
+
+        # Either all matching songs are tagged, or none.
+        changed = 0
+        db.begin_transaction()
+        try:
+            for docid in docids:
+                doc = db.get_document(docid)
+                terms = set(tag_term(t) for t in document_tags(doc))
+                remove = [t for t in removeTerms if t in terms]
+                add = [t for t in addTerms if t not in terms]
+                if not remove and not add:
+                    continue
+
+                for term in remove:
+                    doc.remove_term(term)
+                for term in add:
+                    doc.add_boolean_term(term)
+                # The document is only changed in its terms, so only
+                # they are written.
+                db.replace_document(docid, doc)
+                changed += 1
+            db.commit_transaction()
+        except:
+            db.cancel_transaction()
+            raise
     finally:
         db.close()
+    return changed
 
 def add_tag(dbpath, querystring, addTag):
     "Add the tag <tag> to all songs matching <querystring>."
@@ -267,10 +1047,78 @@ def remove_tag(dbpath, querystring, removeTag):
 
 def all_songs(dbpath):
     "Iterator over all songs stored in the database <dbpath>."
-    db = xapian.Database(dbpath)
+    db = open_database(dbpath)
 
     documents = (db.get_document(post.docid)
                    for post in db.postlist(""))
 
-    return ({'id' : doc.get_docid(), 'data' : json.loads(doc.get_data())}
+    return ({'id' : doc.get_docid(), 'data' : document_song(doc)}
              for doc in documents)
+
+def _export_block(items):
+    """Return the number of (docid, payload, tags) items and their
+    NDJSON lines. Module level, so that worker processes can run it."""
+    lines = []
+    for docid, payload, tags in items:
+        song = decode_song(payload)
+        song['tags'] = tags
+        lines.append(json.dumps({'id' : docid, 'data' : song}) + "\n")
+    return len(items), "".join(lines)
+
+def _export_items(db, chunk_size):
+    """Generator of lists of chunk_size (docid, payload, tags) items of
+    the songs of the xapian database db, in docid order."""
+    chunk = []
+    for post in db.postlist(""):
+        doc = db.get_document(post.docid)
+        chunk.append((post.docid, doc.get_data(), document_tags(doc)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def export(dbpath, out, processes=None, chunk_size=EXPORT_CHUNK_SIZE,
+           inflight=None, progress=None):
+    """Write every song in the database at dbpath to the file object
+    out as NDJSON, one {"id": ..., "data": ...} object per line like
+    all_songs(), in docid order. Documents are read in this process,
+    and with processes, decoded and encoded by that many worker
+    processes, at most inflight (by default two per process) blocks
+    of chunk_size songs at a time. progress, if given, is called with
+    the number of songs and bytes written and the seconds taken so far
+    after every block. Returns the number of songs and bytes written."""
+    db = open_database(dbpath)
+    start_time = time.time()
+    count = 0
+    size = 0
+
+    items = _export_items(db, chunk_size)
+    pool = None
+    if processes:
+        pool = multiprocessing.Pool(processes)
+        blocks = parallel.imap_bounded(pool, _export_block, items,
+                                       inflight or 2 * processes)
+    else:
+        blocks = imap(_export_block, items)
+
+    try:
+        for songs, lines in blocks:
+            out.write(lines)
+            count += songs
+            size += len(lines)
+            if progress:
+                progress(count, size, time.time() - start_time)
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            # Stops the workers at once if we were interrupted.
+            pool.terminate()
+            pool.join()
+        db.close()
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    logging.info("Exported %d songs (%d bytes) in %f s (%f songs/s)."
+                 % (count, size, elapsed, count / elapsed))
+    return count, size
@@ -1,57 +1,378 @@
 # -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import islice
+from math import ceil
 from playlist import transport as ts
+from playlist.normalize import normalize, song_keys
 from Levenshtein import ratio
 
+# Both title and artist must be closer than this for a match.
+THRESHOLD = 0.80
+
+# Number of songs to index at a time when matching against a stream.
+CHUNK_SIZE = 10000
+
+# Number of candidates kept per playlist entry when scoring.
+TOP_K = 3
+
+# Seconds a song may differ in length from a playlist entry and still
+# be a candidate, where lengths are known. None turns the check off.
+LENGTH_WINDOW = 10
+
+# Number of best index hits per playlist entry checked by match_xapian.
+XAPIAN_HITS = 10
+
 def levenshtein_ok(fl_title, fl_artist, ls_artist, ls_title):
 
     title_closeness = ratio(fl_title, ls_title)
 
     # TODO We should really examine these fields and see which are most unique.
     # We should also examine various threshold values
-    if title_closeness > 0.80:
+    if title_closeness > THRESHOLD:
         artist_closeness = ratio(fl_artist, ls_artist)
-        if artist_closeness > 0.80:
+        if artist_closeness > THRESHOLD:
             return True
         else:
             return False
 
+def title_grams(title):
+    "Return the character bigrams of title, repeats included."
+    return [title[i:i+2] for i in xrange(len(title) - 1)]
 
-def match_transport(pl, songs):
-    """Return a playlist with matches (search paths) for transport
-    playlist pl in the song collection songs."""
+def length_window(length, threshold=THRESHOLD):
+    """Return the (shortest, longest) lengths a string can have and
+    still be closer than threshold to a string of the given length."""
+    # ratio() is 2*LCS/(m + n), and the LCS is at most the shorter
+    # string, so min(m, n) * (2 - threshold) > max(m, n) * threshold.
+    # The small slack errs on the side of too wide a window.
+    shortest = int(length * threshold / (2 - threshold) - 1e-9) + 1
+    if threshold > 0:
+        longest = int(ceil(length * (2 - threshold) / threshold + 1e-9)) - 1
+    else:
+        longest = None
+    return max(shortest, 0), longest
 
-    found_songs = [None]*len(pl["playlist"])
+def song_duration(song):
+    """Return the duration in seconds of a library song tuple, or None
+    if it isn't known (as for plain (title, artist, location) tuples
+    or songs Rhythmbox hasn't scanned yet)."""
+    if len(song) > 3:
+        return song[3]
+    return None
+
+
+class SongIndex(object):
+    """A blocking index over the titles of a song collection, so that
+    each playlist entry is only compared against the few songs that
+    could possibly be close enough.
+
+    Candidates are found through shared title bigrams. The bigram
+    filter is lossless: if ratio(a, b) > threshold, every longest
+    common subsequence of a and b has at least 3*LCS - 1 - (m + n)
+    character pairs that are adjacent in both strings, and each of
+    those is a shared bigram.
+
+    Titles and artists are indexed and compared in their canonical
+    forms (see playlist.normalize), kept in keys, which are taken
+    from the songs when they carry them.
+
+    Songs can also be restricted to those within a window of a given
+    duration, through a list of the songs sorted on duration. Songs
+    of unknown duration are always kept."""
+
+    def __init__(self, songs):
+        self.songs = list(songs)
+        self.keys = [song_keys(song) for song in self.songs]
+        self.postings = defaultdict(list)
+        self.lengths = defaultdict(list)
+        by_duration = []
+        self.unknown_durations = []
+
+        for pos, song in enumerate(self.songs):
+            title = self.keys[pos][0]
+            self.lengths[len(title)].append(pos)
+            for gram in set(title_grams(title)):
+                self.postings[gram].append(pos)
+
+            duration = song_duration(song)
+            if duration is None:
+                self.unknown_durations.append(pos)
+            else:
+                by_duration.append((duration, pos))
+
+        by_duration.sort()
+        self.durations = [duration for duration, pos in by_duration]
+        self.duration_positions = [pos for duration, pos in by_duration]
+
+    def __len__(self):
+        return len(self.songs)
 
+    def within(self, duration, window):
+        """Return the set of positions of the songs within window
+        seconds of duration, or of unknown duration."""
+        first = bisect_left(self.durations, duration - window)
+        last = bisect_right(self.durations, duration + window)
+        positions = set(self.duration_positions[first:last])
+        positions.update(self.unknown_durations)
+        return positions
+
+    def candidates(self, title, threshold=THRESHOLD, duration=None,
+                   window=None):
+        """Return the positions of all songs in the index, in
+        ascending order, whose canonical title could be closer than
+        threshold to the canonical title title. With duration and window, only songs within window
+        seconds of duration (or of unknown duration) are included."""
+        m = len(title)
+        shortest, longest = length_window(m, threshold)
+
+        # The least number of bigrams a close enough title must share
+        # with this one. The bound grows with the combined length as
+        # long as threshold > 2/3, so the shortest candidates decide.
+        required = 0
+        if threshold * 3 > 2:
+            size = m + shortest
+            required = int(ceil((1.5 * threshold - 1) * size - 1 - 1e-9))
+
+        def title_fits(p):
+            length = len(self.keys[p][0])
+            return length >= shortest and (longest is None or
+                                           length <= longest)
+
+        positions = set()
+        if required < 1:
+            # Too short (or too lenient) for the bigrams to tell us
+            # anything; fall back on everything of a sensible length.
+            if duration is not None and window is not None:
+                return sorted(p for p in self.within(duration, window)
+                              if title_fits(p))
+            for length in self.lengths:
+                if length >= shortest and (longest is None or
+                                           length <= longest):
+                    positions.update(self.lengths[length])
+            return sorted(positions)
+
+        # Any title sharing `required' bigrams with this one must
+        # share at least one bigram outside of the `required - 1' most
+        # common ones.
+        grams = title_grams(title)
+        grams.sort(key=lambda g: len(self.postings.get(g, ())),
+                   reverse=True)
+
+        for gram in set(grams[required - 1:]):
+            positions.update(self.postings.get(gram, ()))
+
+        if duration is not None and window is not None:
+            def duration_fits(p):
+                d = song_duration(self.songs[p])
+                return d is None or abs(d - duration) <= window
+        else:
+            duration_fits = lambda p: True
+
+        return sorted(p for p in positions
+                      if title_fits(p) and duration_fits(p))
+
+
+def match_index(pl, index, found_songs, window=LENGTH_WINDOW):
+    """Fill in the entries of found_songs (the matches so far for
+    transport playlist pl) that are still None with songs from the
+    SongIndex index within window seconds of the entry's length."""
+
+    # Map the position of each library song to the playlist entries
+    # it is close enough to.
+    hits = defaultdict(list)
+    for i, pls_song in enumerate(pl["playlist"]):
+        if found_songs[i] != None:
+            continue
+        ls_title = normalize(pls_song["title"])
+        ls_artist = normalize(pls_song["artist"])
+        for pos in index.candidates(ls_title,
+                                    duration=int(pls_song["length"]),
+                                    window=window):
+            title, artist = index.keys[pos]
+            if levenshtein_ok(fl_title=title, fl_artist=artist,
+                              ls_artist=ls_artist, ls_title=ls_title):
+                hits[pos].append(i)
+
+    # Hand out the songs in library order, each to the first entry
+    # still missing one, just like a plain scan of the library would.
+    for pos in sorted(hits):
+        for i in hits[pos]:
+            if found_songs[i] == None:
+                found_songs[i] = index.songs[pos][2]
+                break
+
+    return found_songs
+
+def check_playlist(pl, methods=("levenshtein",)):
+    """Throw an exception unless pl is a playlist we know how to
+    match, with one of the match methods in methods."""
     if not ts.valid_playlist(pl):
         raise Exception("Invalid playlist format!")
-        return []
 
-    if not ts.allowed_match("levenshtein", pl):
+    if not any(ts.allowed_match(method, pl) for method in methods):
         raise Exception("Playlist requires unsupported match method!")
-        return []
 
-    for song in songs:
-        title, artist, location = song
 
-        if not None in found_songs:
-            # We've already found all songs!
-            break
-        
-        
-        for i in xrange(len(pl["playlist"])):
-            if found_songs[i] != None:
-                # Already found song
+class Candidate(object):
+    """A library song scored against a playlist entry: the title and
+    artist closeness, their mean (score) and the song's location and
+    position in the library."""
+    __slots__ = ('score', 'title_score', 'artist_score', 'location',
+                 'position')
+
+    def __init__(self, title_score, artist_score, location, position):
+        self.score = (title_score + artist_score) / 2
+        self.title_score = title_score
+        self.artist_score = artist_score
+        self.location = location
+        self.position = position
+
+    def passes(self, threshold):
+        "Would levenshtein_ok() accept this song with threshold?"
+        return (self.title_score > threshold and
+                self.artist_score > threshold)
+
+    def __repr__(self):
+        return "Candidate(%.3f, %r)" % (self.score, self.location)
+
+
+def _ranking(candidate):
+    # Best score first, earlier in the library on ties.
+    return -candidate.score, candidate.position
+
+def score_index(pl, index, scores, k=TOP_K, floor=THRESHOLD, offset=0,
+                window=LENGTH_WINDOW):
+    """Merge the k best songs of the SongIndex index for every entry
+    of transport playlist pl into the candidate lists in scores.
+    offset is the library position of the first song of index."""
+    for i, pls_song in enumerate(pl["playlist"]):
+        found = scores[i]
+        ls_title = normalize(pls_song["title"])
+        ls_artist = normalize(pls_song["artist"])
+        for pos in index.candidates(ls_title, floor,
+                                    int(pls_song["length"]), window):
+            title, artist = index.keys[pos]
+            title_score = ratio(title, ls_title)
+            if title_score <= floor:
                 continue
-            
-            pls_song = pl["playlist"][i]
-            if levenshtein_ok(fl_title=title, fl_artist=artist,
-                              ls_artist=pls_song["artist"],
-                              ls_title=pls_song["title"]):
-                found_songs[i] = location
+            artist_score = ratio(artist, ls_artist)
+            if artist_score <= floor:
+                continue
+            found.append(Candidate(title_score, artist_score,
+                                   index.songs[pos][2], offset + pos))
+        found.sort(key=_ranking)
+        del found[k:]
+    return scores
+
+def score_transport(pl, songs, k=TOP_K, floor=THRESHOLD,
+                    chunk_size=CHUNK_SIZE, window=LENGTH_WINDOW):
+    """Return a list with the k best Candidate songs, best first, of
+    each entry of transport playlist pl in the song collection songs
+    (as for match_transport). Only songs that pass floor are kept, so
+    the list can be assign()ed with any threshold of at least floor
+    without scanning the library again."""
+    check_playlist(pl)
+    scores = [[] for song in pl["playlist"]]
+
+    if isinstance(songs, SongIndex):
+        return score_index(pl, songs, scores, k, floor, window=window)
+
+    songs = iter(songs)
+    offset = 0
+    while True:
+        index = SongIndex(islice(songs, chunk_size))
+        if not len(index):
+            break
+        score_index(pl, index, scores, k, floor, offset, window)
+        offset += len(index)
+
+    return scores
+
+def assign(scores, threshold=THRESHOLD):
+    """Return a list with the chosen Candidate (or None) for each
+    entry of scores, as returned by score_transport. Conflicts are
+    resolved by global best score: the best scoring (entry, song) pair
+    of all is settled first, then the best of the rest, and so on, so
+    each song goes to the entry it fits best."""
+    pairs = [(candidate, i) for i, candidates in enumerate(scores)
+             for candidate in candidates if candidate.passes(threshold)]
+    pairs.sort(key=lambda (candidate, i): _ranking(candidate) + (i,))
+
+    chosen = [None]*len(scores)
+    taken = set()
+    for candidate, i in pairs:
+        if chosen[i] is None and candidate.position not in taken:
+            chosen[i] = candidate
+            taken.add(candidate.position)
+    return chosen
+
+def match_transport(pl, songs, chunk_size=CHUNK_SIZE, best=False,
+                    window=LENGTH_WINDOW):
+    """Return a playlist with matches (search paths) for transport
+    playlist pl in the song collection songs. songs is either an
+    iterable of (title, artist, location, duration) tuples (optionally
+    followed by their canonical title and artist) or a SongIndex.
+    Titles and artists are compared in canonical form. Only songs within window seconds of an entry's length
+    are considered for it; songs of unknown duration (or given as
+    (title, artist, location) tuples) are always considered.
+
+    By default each library song goes to the first entry it is close
+    enough to, iterables are indexed chunk_size songs at a time, and
+    reading stops as soon as every song in the playlist has been
+    found. If best is True, the whole library is scored and songs are
+    assign()ed by best score instead."""
+
+    check_playlist(pl)
+
+    if best:
+        return [candidate.location if candidate else None
+                for candidate in assign(score_transport(
+                    pl, songs, chunk_size=chunk_size, window=window))]
+
+    found_songs = [None]*len(pl["playlist"])
+
+    if isinstance(songs, SongIndex):
+        return match_index(pl, songs, found_songs, window)
+
+    songs = iter(songs)
+    while None in found_songs:
+        index = SongIndex(islice(songs, chunk_size))
+        if not len(index):
+            break
+        # Earlier chunks come earlier in the library, so matching
+        # them one at a time hands out songs in the same order.
+        match_index(pl, index, found_songs, window)
+
+    return found_songs
+
+def match_xapian(pl, dbpath, window=LENGTH_WINDOW, hits=XAPIAN_HITS):
+    """Return a playlist with matches (paths) for transport playlist
+    pl in the xapian music database at dbpath. Each entry is looked up
+    by title and artist among the songs within window seconds of its
+    length (or of any length if window is None), and the first of the
+    best hits levenshtein_ok() accepts is the match. Playlists that
+    allow either the "xapian" or "levenshtein" methods are accepted."""
+    # Only needed here, so plain Rhythmbox matching works without
+    # the xapian bindings.
+    from db import xapian_music
+
+    check_playlist(pl, ("xapian", "levenshtein"))
+
+    found_songs = [None]*len(pl["playlist"])
+    for i, pls_song in enumerate(pl["playlist"]):
+        # The index has its own stemming; only the check normalizes.
+        ls_title = normalize(pls_song["title"])
+        ls_artist = normalize(pls_song["artist"])
+        for match in xapian_music.find_song(dbpath, pls_song["title"],
+                                            pls_song["artist"],
+                                            int(pls_song["length"]),
+                                            window, hits):
+            data = match['data']
+            if levenshtein_ok(fl_title=normalize(data['title']),
+                              fl_artist=normalize(data['artist']),
+                              ls_artist=ls_artist, ls_title=ls_title):
+                found_songs[i] = data['path']
                 break
 
     return found_songs
-            
-            
-            
-        
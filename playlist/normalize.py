@@ -0,0 +1,58 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Canonical forms of titles and artists for matching, so that case,
+# diacritics, "feat." credits and punctuation don't count against an
+# otherwise good match: u"Spökstad (feat. Someone)" becomes u"spokstad".
+import re
+import unicodedata
+
+# A featured artist credit and everything after it.
+FEATURING = re.compile(r"\s*(?:[(\[]\s*(?:feat|ft|featuring)\b"
+                       r"|\b(?:feat|ft)\."
+                       r"|\bfeaturing\b).*$", re.I | re.U)
+# Apostrophes join words ("don't"); other punctuation separates them.
+APOSTROPHES = re.compile(u"['’`]", re.U)
+PUNCTUATION = re.compile(r"[\W_]+", re.U)
+
+# Number of canonical forms to keep around, mostly for playlist
+# entries, which are normalized again for every library chunk.
+CACHE_SIZE = 10000
+
+_cache = {}
+
+
+def _normalize(s):
+  s = unicodedata.normalize("NFKD", unicode(s))
+  s = u"".join(c for c in s if not unicodedata.combining(c)).lower()
+
+  credit = FEATURING.search(s)
+  if credit and credit.start() > 0:
+    s = s[:credit.start()]
+
+  canonical = u" ".join(PUNCTUATION.sub(u" ", APOSTROPHES.sub(u"", s)).split())
+  # Titles like "..." would all be the same otherwise.
+  return canonical or s.strip()
+
+def normalize(s):
+  "Return the canonical form of the title or artist name s."
+  try:
+    return _cache[s]
+  except KeyError:
+    if len(_cache) >= CACHE_SIZE:
+      _cache.clear()
+    canonical = _cache[s] = _normalize(s)
+    return canonical
+
+def song_keys(song):
+  """Return the canonical (title, artist) of a library song tuple,
+  from the tuple itself if it carries them (see with_keys)."""
+  if len(song) > 5:
+    return song[4], song[5]
+  return _normalize(song[0]), _normalize(song[1])
+
+def with_keys(songs):
+  """Generator adding the canonical title and artist to each
+  (title, artist, location, duration) tuple in songs, so they can be
+  computed once and stored with the library."""
+  for song in songs:
+    yield tuple(song[:4]) + (_normalize(song[0]), _normalize(song[1]))
@@ -0,0 +1,161 @@
+# -*- mode: Python; encoding: utf-8; indent-tabs-mode: nil; tab-width: 2 -*-
+
+# Batched fuzzy scoring: the Levenshtein.ratio() of one string against
+# a whole array of strings in a single call, with the loop over the
+# candidates done by NumPy instead of the interpreter.
+#
+# ratio() is 2*LCS/(m + n), so all we need is the length of the
+# longest common subsequence of the query and each candidate. That is
+# computed with the bit-parallel algorithm of Hyyrö (2004), keeping one
+# machine word of state per candidate and advancing every candidate by
+# one character per step.
+import sys
+import numpy as np
+from Levenshtein import ratio
+
+from playlist.match import THRESHOLD
+from playlist.normalize import normalize, song_keys
+
+# The query has one bit per character; longer queries are scored one
+# candidate at a time instead.
+WORD_BITS = 64
+
+# Code units as Python sees them, so that lengths agree with len()
+# and with Levenshtein.ratio() on narrow builds too.
+if sys.maxunicode > 0xffff:
+  _ENCODING, _UNIT = "utf-32-le", np.uint32
+else:
+  _ENCODING, _UNIT = "utf-16-le", np.uint16
+
+# Number of set bits of every byte value.
+_POPCOUNT = np.array([bin(i).count("1") for i in xrange(256)],
+                     dtype=np.uint8)
+
+
+def _text(s):
+  # Byte strings are compared byte by byte, as by ratio().
+  if isinstance(s, str):
+    return s.decode("latin-1")
+  return s
+
+def _popcount(words):
+  "Return the number of set bits of each uint64 in words."
+  return _POPCOUNT[words.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class Strings(object):
+  """An array of candidate strings prepared once for scoring against
+  any number of queries.
+
+  The strings are kept as a matrix of character codes, one column
+  per character position, sorted on length (longest first) so that
+  step j of the scan only touches the strings that are longer than
+  j. Character codes are numbered densely over the alphabet that
+  actually occurs, so that the per-query lookup table stays small."""
+
+  def __init__(self, strings):
+    self.strings = [_text(s) for s in strings]
+    lengths = np.array([len(s) for s in self.strings], dtype=np.int64)
+    self.lengths = lengths
+    self.order = np.argsort(-lengths, kind="mergesort")
+    self.width = int(lengths.max()) if len(lengths) else 0
+
+    # active[j] is the number of strings longer than j.
+    counts = np.bincount(lengths, minlength=self.width + 1)
+    self.active = len(lengths) - np.cumsum(counts)[:self.width]
+
+    padded = u"".join(self.strings[i].ljust(self.width, u"\0")
+                      for i in self.order)
+    units = np.frombuffer(padded.encode(_ENCODING), dtype=_UNIT)
+    self.alphabet, codes = np.unique(units, return_inverse=True)
+    self.columns = np.ascontiguousarray(
+      codes.astype(np.int32).reshape(len(lengths), self.width).T)
+
+  def __len__(self):
+    return len(self.strings)
+
+  def _match_table(self, query):
+    "Return the query bit mask of each code of the alphabet."
+    table = np.zeros(len(self.alphabet), dtype=np.uint64)
+    units = np.frombuffer(query.encode(_ENCODING), dtype=_UNIT)
+    positions = np.searchsorted(self.alphabet, units)
+    for bit, (unit, i) in enumerate(zip(units, positions)):
+      if i < len(self.alphabet) and self.alphabet[i] == unit:
+        table[i] |= np.uint64(1) << np.uint64(bit)
+    return table
+
+  def lcs(self, query):
+    """Return an array of the lengths of the longest common
+    subsequences of query and each string, in the original order."""
+    query = _text(query)
+    m = len(query)
+    if m > WORD_BITS:
+      raise ValueError("Query longer than %d characters." % WORD_BITS)
+
+    table = self._match_table(query)
+    state = np.empty(len(self), dtype=np.uint64)
+    state.fill(np.iinfo(np.uint64).max)
+
+    for j in xrange(self.width):
+      k = self.active[j]
+      v = state[:k]
+      match = table[self.columns[j, :k]]
+      # V' = (V + (V & M)) | (V & ~M); zero bits count the LCS.
+      carry = v + (v & match)
+      v &= ~match
+      v |= carry
+
+    if m < WORD_BITS:
+      state &= np.uint64((1 << m) - 1)
+    lcs = np.empty(len(self), dtype=np.int64)
+    lcs[self.order] = m - _popcount(state).astype(np.int64)
+    return lcs
+
+  def ratios(self, query):
+    """Return an array of Levenshtein.ratio(query, s) for every string
+    s, in the original order."""
+    query = _text(query)
+    if len(query) > WORD_BITS:
+      return np.array([ratio(query, s) for s in self.strings])
+
+    total = self.lengths + len(query)
+    scores = np.ones(len(self), dtype=np.float64)
+    nonempty = total > 0
+    scores[nonempty] = (2.0 * self.lcs(query)[nonempty]) / total[nonempty]
+    return scores
+
+  def extract(self, query, threshold=THRESHOLD, limit=None):
+    """Return a list of (score, position) pairs of the strings closer
+    than threshold to query, best first, at most limit of them."""
+    scores = self.ratios(query)
+    positions = np.flatnonzero(scores > threshold)
+    # Stable on position, so ties come in the original order.
+    positions = positions[np.argsort(-scores[positions], kind="mergesort")]
+    if limit is not None:
+      positions = positions[:limit]
+    return [(float(scores[p]), int(p)) for p in positions]
+
+
+class SongScorer(object):
+  """The canonical titles and artists of a list of library song
+  tuples, prepared for scoring playlist entries against all of them
+  at once."""
+
+  def __init__(self, songs):
+    self.songs = list(songs)
+    keys = [song_keys(song) for song in self.songs]
+    self.titles = Strings(title for title, artist in keys)
+    self.artists = Strings(artist for title, artist in keys)
+
+  def scores(self, entry):
+    """Return the arrays of title and artist closeness of the
+    playlist entry entry to every song."""
+    return (self.titles.ratios(normalize(entry["title"])),
+            self.artists.ratios(normalize(entry["artist"])))
+
+  def matches(self, entry, threshold=THRESHOLD):
+    """Return the positions, in library order, of the songs that
+    match_transport would consider close enough to entry."""
+    title_scores, artist_scores = self.scores(entry)
+    return np.flatnonzero((title_scores > threshold)
+                          & (artist_scores > threshold)).tolist()
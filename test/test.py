@@ -66,10 +66,67 @@ def test_rhythmbox_db_get_songs():
   songs = rb.get_songs(TEST_DB)
 
   for song in songs:
-    assert len(song) == 3
-    assert not None in song
+    assert len(song) == 4
+    assert not None in song[:3]
     assert song != None
 
+def test_rhythmbox_db_streaming():
+  from db import rhythmbox as rb
+  from os import remove
+
+  TEMP_FILE = os.path.join(TESTDIR, "rhythmdb_stream_test.xml")
+
+  with open(TEMP_FILE, "w") as rdb:
+    rdb.write('<?xml version="1.0" standalone="yes"?>\n'
+              '<rhythmdb version="1.8">'
+              '<entry type="iradio"><title>Radio</title>'
+              '<location>http://radio.example.com/</location></entry>'
+              '<entry type="song"><title>Spökstad</title><artist>Kent</artist>'
+              '<location>file:///music/02-spokstad%20(live).ogg</location>'
+              '<duration>254</duration></entry>'
+              '<entry type="song"><title>No artist</title>'
+              '<location>file:///music/no_artist.mp3</location></entry>'
+              '<entry type="song"><title>Unscanned</title><artist>Kent</artist>'
+              '<location>file:///music/unscanned.ogg</location>'
+              '<duration>0</duration></entry>'
+              '</rhythmdb>')
+  try:
+    songs = rb.get_songs(TEMP_FILE)
+    assert songs.next() == (u"Spökstad", u"Kent",
+                            u"/music/02-spokstad (live).ogg", 254)
+    assert list(songs) == [(u"Unscanned", u"Kent",
+                            u"/music/unscanned.ogg", None)]
+  finally:
+    remove(TEMP_FILE)
+
+def test_snapshot():
+  from db import snapshot
+  from playlist.normalize import with_keys
+  from os import remove
+
+  SOURCE = os.path.join(TESTDIR, "reference.json")
+  TEMP_FILE = os.path.join(TESTDIR, "snapshot_test.snapshot")
+
+  songs = list(with_keys([
+    (u"Spökstad", u"Kent", u"/music/02-spokstad.ogg", 254),
+    (u"Streamline", u"VNV Nation", u"/music/06-streamline.mp3", None)]))
+  reads = []
+
+  def reader(source):
+    reads.append(source)
+    return iter(songs)
+
+  try:
+    assert snapshot.get_songs(SOURCE, TEMP_FILE, reader) == songs
+    assert snapshot.get_songs(SOURCE, TEMP_FILE, reader) == songs
+    # The second call must come from the snapshot...
+    assert len(reads) == 1
+    # ...but a changed source invalidates it.
+    mtime, size = snapshot.source_stamp(SOURCE)
+    assert snapshot.read(TEMP_FILE, (mtime + 1, size)) == None
+  finally:
+    remove(TEMP_FILE)
+
 def test_dirtree_db_get_songs():
   from db import dirtree as dt
   MUSIC_DIR = os.path.join(TESTDIR, "music_dir/")
@@ -85,6 +142,76 @@ def test_dirtree_db_get_songs():
       # These keys must also have real vaules:
       assert song[key] != None
 
+def test_songdata():
+  from db import dirtree as dt
+  from db.xapian_music import mergeSongs
+  import pickle
+
+  song = dt.parseFile(os.path.join(TESTDIR, "music_dir/06-streamline.mp3"))
+  assert not hasattr(song, "__dict__")
+  assert song.title == song['title'] == u"Streamline"
+  assert u"{artist} – {title}".format(**song) == u"VNV Nation – Streamline"
+  assert dict(song) == song
+  assert pickle.loads(pickle.dumps(song, 2)) == song
+
+  song['playcount'] = 3
+  assert 'playcount' in song and song.get('playcount') == 3
+  assert mergeSongs(song, dict(song, rating=u"0.8"))['rating'] == u"0.8"
+
+  try:
+    dt.SongData(title=u"Streamline")
+    assert False
+  except KeyError:
+    pass
+
+def test_fasttags():
+  from db import dirtree as dt
+  from db import fasttags
+
+  # The header-only reader must agree with mutagen on every field
+  # parseFile uses.
+  keys = ["title", "artist", "album", "date", "tracknumber", "genre",
+          "rating:banshee"]
+
+  for path in dt.get_files(os.path.join(TESTDIR, "music_dir")):
+    fast = fasttags.read(path)
+    full = dt.read_metadata_from_file(path)
+    assert int(fast.info.length) == int(full.info.length)
+    for key in keys:
+      assert fast.get(key, [None])[0] == full.get(key, [None])[0]
+
+  try:
+    fasttags.read(os.path.join(TESTDIR, "reference.json"))
+    assert False
+  except fasttags.UnsupportedFile:
+    pass
+
+def test_dirtree_parallel_get_songs():
+  from db import dirtree as dt
+  MUSIC_DIR = os.path.join(TESTDIR, "music_dir/")
+
+  serial = list(dt.get_songs(MUSIC_DIR))
+  assert list(dt.get_songs(MUSIC_DIR, processes=2, inflight=1)) == serial
+
+  unordered = list(dt.get_songs(MUSIC_DIR, processes=2, ordered=False))
+  assert sorted(s['path'] for s in unordered) == \
+      sorted(s['path'] for s in serial)
+
+  # Filters still run, and still see every file.
+  seen = []
+  def prefilter(path, mtime):
+    seen.append(path)
+    return not path.endswith(".mp3")
+
+  songs = list(dt.get_songs(MUSIC_DIR, prefilter=prefilter,
+                            postfilter=lambda s: s['artist'] != "Kent",
+                            processes=2))
+  assert len(seen) == len(list(dt.get_files(MUSIC_DIR)))
+  assert songs
+  for song in songs:
+    assert not song['path'].endswith(".mp3")
+    assert song['artist'] != "Kent"
+
 
 def test_parse_reference_playlist():
   from playlist import transport as ts
@@ -163,6 +290,141 @@ def test_match():
   for i in xrange(len(matched)):
     assert matched[i] == compiled_playlist[i]
 
+def test_match_index():
+  from playlist import match
+  from playlist import transport as ts
+
+  songs = [(u"The Great Divide", u"VNV Nation", u"/a.flac"),
+           (u"Great Divide", u"VNV Nation", u"/b.flac"),
+           (u"Streamline", u"VNV Nation", u"/c.mp3"),
+           (u"Streamlined", u"VNV Nation", u"/d.mp3"),
+           (u"Spökstad", u"Kent", u"/e.ogg"),
+           (u"A", u"Kent", u"/f.ogg")]
+  playlist = ts.make_playlist([ts.make_song(u"VNV Nation", 315, u"The Great Divide"),
+                               ts.make_song(u"VNV Nation", 315, u"The Great Divides"),
+                               ts.make_song(u"VNV Nation", 300, u"Streamlined"),
+                               ts.make_song(u"Kent", 200, u"Spokstad"),
+                               ts.make_song(u"Kent", 100, u"A"),
+                               ts.make_song(u"Opeth", 600, u"Ghost of Perdition")],
+                              "http://test.com/test.json", "Test playlist")
+
+  # The index must never miss a song a plain pairwise scan would find.
+  index = match.SongIndex(songs)
+  for entry in playlist['playlist']:
+    title = match.normalize(entry['title'])
+    candidates = index.candidates(title)
+    for pos, (song_title, song_artist) in enumerate(index.keys):
+      if match.ratio(song_title, title) > match.THRESHOLD:
+        assert pos in candidates
+
+  assert match.match_transport(playlist, index) == \
+      [u"/a.flac", u"/b.flac", u"/c.mp3", u"/e.ogg", u"/f.ogg", None]
+  assert match.match_transport(playlist, iter(songs), chunk_size=2) == \
+      match.match_transport(playlist, index)
+
+def test_normalize():
+  from playlist import match
+  from playlist import transport as ts
+  from playlist.normalize import normalize, with_keys
+
+  assert normalize(u"Spökstad (feat. Someone Else)") == u"spokstad"
+  assert normalize(u"Don’t Stop  Me Now!") == u"dont stop me now"
+  assert normalize(u"Song ft. X") == normalize(u"Song [Featuring X]") == u"song"
+  assert normalize(u"The Great Defeat") == u"the great defeat"
+  assert normalize(u"...") == u"..."
+
+  songs = list(with_keys([(u"SPÖKSTAD", u"Kent", u"/e.ogg", None),
+                          (u"Streamline", u"VNV Nation", u"/c.mp3", None)]))
+  assert songs[0][4:] == (u"spokstad", u"kent")
+  # The stored keys are used as they are.
+  songs[1] = songs[1][:4] + (u"spokstad", u"kent")
+  playlist = ts.make_playlist([ts.make_song(u"kent", 200,
+                                            u"Spökstad (feat. Nobody)")],
+                              "http://test.com/test.json", "Test playlist")
+  index = match.SongIndex(songs)
+  assert index.keys[0] == (u"spokstad", u"kent")
+  assert match.match_transport(playlist, index) == [u"/e.ogg"]
+  assert [c.location for c in match.score_transport(playlist, index)[0]] == \
+      [u"/e.ogg", u"/c.mp3"]
+
+def test_match_length_window():
+  from playlist import match
+  from playlist import transport as ts
+
+  songs = [(u"Streamline", u"VNV Nation", u"/radio-edit.mp3", 240),
+           (u"Streamline", u"VNV Nation", u"/album.mp3", 302),
+           (u"Streamline", u"VNV Nation", u"/unknown.mp3", None),
+           (u"A", u"Kent", u"/a-long.ogg", 500),
+           (u"A", u"Kent", u"/a.ogg", 100)]
+  playlist = ts.make_playlist([ts.make_song(u"VNV Nation", 300, u"Streamline"),
+                               ts.make_song(u"VNV Nation", 100, u"Streamline"),
+                               ts.make_song(u"Kent", 100, u"A")],
+                              "http://test.com/test.json", "Test playlist")
+
+  index = match.SongIndex(songs)
+  assert index.candidates(u"Streamline", duration=300, window=5) == [1, 2]
+  assert index.candidates(u"A", duration=100, window=5) == [4]
+
+  assert match.match_transport(playlist, index) == \
+      [u"/album.mp3", u"/unknown.mp3", u"/a.ogg"]
+  assert match.match_transport(playlist, index, best=True) == \
+      [u"/album.mp3", u"/unknown.mp3", u"/a.ogg"]
+  assert match.match_transport(playlist, index, window=None) == \
+      [u"/radio-edit.mp3", u"/album.mp3", u"/a-long.ogg"]
+
+def test_match_best():
+  from playlist import match
+  from playlist import transport as ts
+
+  songs = [(u"Streamline", u"VNV Nation", u"/x.mp3"),
+           (u"Streamlines", u"VNV Nation", u"/y.mp3")]
+  playlist = ts.make_playlist([ts.make_song(u"VNV Nation", 300, u"Streamlines"),
+                               ts.make_song(u"VNV Nation", 300, u"Streamline"),
+                               ts.make_song(u"Opeth", 600, u"Ghost of Perdition")],
+                              "http://test.com/test.json", "Test playlist")
+
+  # The first song is close enough to the first entry, but it is
+  # an exact match for the second one.
+  assert match.match_transport(playlist, songs) == [u"/x.mp3", u"/y.mp3", None]
+  assert match.match_transport(playlist, songs, best=True) == \
+      [u"/y.mp3", u"/x.mp3", None]
+  assert match.match_transport(playlist, iter(songs), chunk_size=1,
+                               best=True) == [u"/y.mp3", u"/x.mp3", None]
+
+  scores = match.score_transport(playlist, songs, floor=0.5)
+  assert [c.location for c in scores[0]] == [u"/y.mp3", u"/x.mp3"]
+  assert scores[0][0].score == 1.0
+  assert scores[2] == []
+
+  # Thresholds can be retuned without scoring again.
+  assert [c and c.location for c in match.assign(scores, 0.99)] == \
+      [u"/y.mp3", u"/x.mp3", None]
+  assert match.assign(scores, 1.0) == [None, None, None]
+
+def test_scoring():
+  from playlist import match
+  from playlist.scoring import Strings, SongScorer
+
+  titles = [u"The Great Divide", u"Great Divide", u"", u"Spökstad",
+            u"Streamline", "Streamlined", u"x" * 70]
+  strings = Strings(titles)
+  for query in [u"The Great Divides", u"Spokstad", u"", "Streamline",
+                u"x" * 65]:
+    assert list(strings.ratios(query)) == \
+        [match.ratio(unicode(query), unicode(title)) for title in titles]
+
+  best = strings.extract(u"Streamlined", limit=2)
+  assert [pos for score, pos in best] == [5, 4]
+  assert best[0][0] == 1.0
+
+  songs = [(u"The Great Divide", u"VNV Nation", u"/a.flac"),
+           (u"Great Divide", u"VNV Nation", u"/b.flac"),
+           (u"The Great Divide", u"Opeth", u"/c.flac")]
+  entry = {"title" : u"The Great Divides", "artist" : u"VNV Nation"}
+  assert SongScorer(songs).matches(entry) == \
+      [pos for pos, (title, artist, location) in enumerate(songs)
+       if match.levenshtein_ok(title, artist, entry["artist"], entry["title"])]
+
 # Helper function for re-indexing for every test, so we don't have to
 # worry about breaking the database.
 def with_index(f):
@@ -182,7 +444,7 @@ def with_index(f):
 
 def test_index():
   from xapian import Database
-  import json
+  from db.xapian_music import decode_song
 
 
   def search_vnv(db):
@@ -206,7 +468,7 @@ def test_index():
       # Ok, this is UGLY, and we should implement a proper interface for this.
       documents = [database.get_document(post.docid)
                    for post in database.postlist("")]
-      songs = [json.loads(doc.get_data()) for doc in documents]
+      songs = [decode_song(doc.get_data()) for doc in documents]
 
       print "The following songs were indexed:"
       for song in songs:
@@ -221,6 +483,109 @@ def test_index():
   with_index(search_false)
   with_index(search_all)
 
+def test_song_payload():
+  from db.xapian_music import encode_song, decode_song
+  from db import dirtree as dt
+  import json
+
+  for song in dt.get_songs(os.path.join(TESTDIR, "music_dir")):
+    payload = encode_song(song)
+    assert decode_song(payload) == song
+    assert len(payload) < len(json.dumps(dict(song)))
+    # Databases from before the binary format still work.
+    assert decode_song(json.dumps(dict(song))) == song
+
+  extra = {'title' : u"Spökstad", 'playcount' : 3}
+  assert decode_song(encode_song(extra))['playcount'] == 3
+
+def test_reindex_unchanged():
+  from db.xapian_music import index, all_songs
+  from db import dirtree as dt
+
+  MUSIC_DIR = os.path.join(TESTDIR, "music_dir")
+
+  def reindex(db):
+    parsed = []
+    parseFile = dt.parseFile
+
+    def counting_parseFile(filePath):
+      parsed.append(filePath)
+      return parseFile(filePath)
+
+    dt.parseFile = counting_parseFile
+    try:
+      index(MUSIC_DIR, db)
+    finally:
+      dt.parseFile = parseFile
+
+    # Nothing has changed since with_index, so nothing is parsed...
+    assert parsed == []
+    # ...and nothing is lost.
+    assert len(list(all_songs(db))) == len(list(dt.get_files(MUSIC_DIR)))
+
+  with_index(reindex)
+
+def test_reindex_disappeared():
+  from db.xapian_music import index, all_songs
+  from shutil import copytree, rmtree
+  from tempfile import mkdtemp
+
+  tmp = mkdtemp()
+  music_dir = os.path.join(tmp, "music_dir")
+  dbpath = os.path.join(tmp, "music.db")
+
+  try:
+    copytree(os.path.join(TESTDIR, "music_dir"), music_dir)
+    # Several transactions' worth of songs.
+    index(music_dir, dbpath, batch_size=4)
+    assert len(list(all_songs(dbpath))) == 6
+
+    gone = os.path.join(music_dir, "06-streamline.mp3")
+    os.remove(gone)
+    index(music_dir, dbpath)
+
+    paths = [song['data']['path'] for song in all_songs(dbpath)]
+    assert len(paths) == 5
+    assert gone not in paths
+  finally:
+    rmtree(tmp)
+
+def test_update_paths():
+  from db.xapian_music import index, update, all_songs
+  from shutil import copy, copytree, rmtree
+  from tempfile import mkdtemp
+
+  tmp = mkdtemp()
+  music_dir = os.path.join(tmp, "music_dir")
+  dbpath = os.path.join(tmp, "music.db")
+
+  def paths():
+    return sorted(song['data']['path'] for song in all_songs(dbpath))
+
+  try:
+    copytree(os.path.join(TESTDIR, "music_dir"), music_dir)
+    index(music_dir, dbpath)
+    before = paths()
+
+    # A new album directory and a deleted file.
+    album = os.path.join(music_dir, "album")
+    os.mkdir(album)
+    copy(os.path.join(music_dir, "06-streamline.mp3"),
+         os.path.join(album, "01-streamline.mp3"))
+    gone = os.path.join(music_dir, "02-spokstad.ogg")
+    os.remove(gone)
+
+    update(dbpath, [album, gone])
+    assert paths() == sorted(set(before) - set([gone]) |
+                             set([os.path.join(album, "01-streamline.mp3")]))
+
+    # Removing the directory removes everything in it.
+    rmtree(album)
+    update(dbpath, [album])
+    assert paths() == sorted(set(before) - set([gone]))
+  finally:
+    rmtree(tmp)
+
 def add_ebm(dbpath):
   from db.xapian_music import add_tag
   from db.xapian_music import search
@@ -260,6 +625,213 @@ def test_remove_tags():
 
   with_index(add_and_remove_ebm)
 
+def test_bulk_tag():
+  from xapian import Database
+  from db.xapian_music import tag, all_songs
+
+  def payloads(db):
+    database = Database(db)
+    try:
+      return dict((post.docid, database.get_document(post.docid).get_data())
+                  for post in database.postlist(""))
+    finally:
+      database.close()
+
+  def retag(db):
+    before = payloads(db)
+    # Small chunks, and a tag that isn't there to remove.
+    assert tag(db, "year..3000", "Inbox -nosuchtag", chunk_size=2) == 6
+    assert tag(db, "year..3000", "inbox", chunk_size=2) == 0
+    assert tag(db, 'artist:"VNV Nation"', "-inbox ebm") == 2
+
+    for song in all_songs(db):
+      if song['data']['artist'] == "VNV Nation":
+        assert "ebm" in song['data']['tags']
+        assert "inbox" not in song['data']['tags']
+      else:
+        assert "inbox" in song['data']['tags']
+      # Tags set at index time are terms too.
+      assert "index" in song['data']['tags']
+    assert len(search(db, "tag:inbox")) == 4
+
+    # Only terms changed; no song data was rewritten.
+    assert payloads(db) == before
+    tag(db, "year..3000", "-inbox -ebm")
+
+  with_index(retag)
+
+def test_facets():
+  from db.xapian_music import facets, all_songs
+
+  def count(db):
+    songs = [song['data'] for song in all_songs(db)]
+    everything = facets(db)
+    for field in ['artist', 'album', 'genre']:
+      values = [song[field] for song in songs if song[field]]
+      assert everything[field] == dict((v, values.count(v)) for v in values)
+    assert everything['tag']['index'] == len(songs)
+
+    vnv = facets(db, 'artist:"VNV Nation"')
+    assert vnv['artist'] == {u"VNV Nation" : 2}
+    assert vnv['tag']['index'] == 2
+    assert sum(vnv['album'].values()) == 2
+
+  with_index(count)
+
+def test_export():
+  from db.xapian_music import export, all_songs
+  from StringIO import StringIO
+  import json
+
+  def export_all(db):
+    songs = [{'id' : song['id'], 'data' : song['data']}
+             for song in all_songs(db)]
+
+    serial = StringIO()
+    assert export(db, serial) == (len(songs), len(serial.getvalue()))
+    assert [json.loads(line) for line in serial.getvalue().splitlines()] \
+        == songs
+
+    reports = []
+    pooled = StringIO()
+    export(db, pooled, processes=2, chunk_size=2, inflight=1,
+           progress=lambda *report: reports.append(report))
+    assert pooled.getvalue() == serial.getvalue()
+    assert [count for count, size, elapsed in reports] == [2, 4, 6]
+
+  with_index(export_all)
+
+def test_index_sharded():
+  from db.xapian_music import index_sharded, shard_dirs, search, \
+      all_songs, add_tag
+  from shutil import rmtree
+  from tempfile import mkdtemp
+
+  tmp = mkdtemp()
+  dbpath = os.path.join(tmp, "music.db")
+  compacted = os.path.join(tmp, "compacted.db")
+  music_dir = os.path.join(TESTDIR, "music_dir")
+  q = 'artist:"VNV Nation"'
+
+  try:
+    index_sharded(music_dir, dbpath, shards=2, compact_to=compacted)
+    assert len(shard_dirs(dbpath)) == 2
+
+    # The shards are searched as one database, and so is their
+    # compacted copy.
+    paths = sorted(song['data']['path'] for song in all_songs(dbpath))
+    assert len(paths) == len(os.listdir(music_dir))
+    assert paths == sorted(song['data']['path']
+                           for song in all_songs(compacted))
+    assert len(search(dbpath, q)) == len(search(compacted, q)) == 2
+
+    add_tag(dbpath, q, "ebm")
+    assert len(search(dbpath, "tag:ebm")) == 2
+
+    # Reindexing keeps the shards and what is in them.
+    index_sharded(music_dir, dbpath)
+    assert len(shard_dirs(dbpath)) == 2
+    assert len(search(dbpath, "tag:ebm")) == 2
+  finally:
+    rmtree(tmp)
+
+def test_compact():
+  from db.xapian_music import compact, search, all_songs, BENCHMARK_QUERIES
+
+  def compact_twice(db):
+    songs = sorted(song['data']['path'] for song in all_songs(db))
+    for i in range(2):
+      report = compact(db)
+      assert report['documents'] == len(songs)
+      assert [q for q, before, after in report['latency']] \
+          == BENCHMARK_QUERIES
+      assert sorted(song['data']['path'] for song in all_songs(db)) == songs
+    # The value slots still work for ranges.
+    assert len(search(db, "year:0..3000")) == \
+        len(search(db, "year:0..3000 OR year:3001..4000"))
+
+  with_index(compact_twice)
+
+def test_searcher():
+  from db.xapian_music import Searcher, add_tag, remove_tag
+
+  def search_twice(db):
+    searcher = Searcher(db)
+    q = 'artist:"VNV Nation"'
+    assert len(searcher.search(q)) == 2
+    assert searcher.queryparser.parse_query(q) is \
+        searcher.queryparser.parse_query(q)
+
+    # Writes by others must show up in the long-lived searcher.
+    assert not searcher.search("tag:fisk")
+    add_tag(db, q, "fisk")
+    assert len(searcher.search("tag:fisk")) == 2
+    remove_tag(db, q, "fisk")
+    assert not searcher.search("tag:fisk")
+
+  with_index(search_twice)
+
+def test_search_page():
+  from db.xapian_music import search_page
+
+  def page_through(db):
+    first = search_page(db, "year..3000", offset=0, limit=4)
+    assert len(first.matches) == 4
+    assert first.estimate == 6
+    rest = search_page(db, "year..3000", offset=4, limit=4)
+    assert len(rest.matches) == 2
+    assert rest.matches[0].rank == 5
+
+    paths = set(m['data']['path'] for m in first.matches + rest.matches)
+    assert len(paths) == 6
+    assert len(search(db, "year..3000", offset=2, limit=3)) == 3
+
+  with_index(page_through)
+
+def test_match_xapian():
+  from playlist import match
+  from playlist import transport as ts
+
+  playlist = ts.make_playlist([ts.make_song(u"VNV Nation", 1, u"Streamlines"),
+                               ts.make_song(u"Kent", 1, u"Spokstad"),
+                               ts.make_song(u"VNV Nation", 300, u"The Great Divide"),
+                               ts.make_song(u"Opeth", 600, u"Ghost of Perdition")],
+                              "http://test.com/test.json", "Test playlist",
+                              allow_match=["xapian"])
+
+  def match_playlist(db):
+    found = match.match_xapian(playlist, db)
+    assert found[0] == os.path.join(TESTDIR, "music_dir/06-streamline.mp3")
+    assert found[1] == os.path.join(TESTDIR, "music_dir/02-spokstad.ogg")
+    # Far too long, unless lengths are ignored.
+    assert found[2] == None
+    assert match.match_xapian(playlist, db, window=None)[2] == \
+        os.path.join(TESTDIR, "music_dir/04-the_great_divide.flac")
+    assert found[3] == None
+
+  with_index(match_playlist)
+
+def test_library_columns():
+  from db.columns import LibraryColumns
+  from db.xapian_music import all_songs
+
+  def aggregate(db):
+    songs = [song['data'] for song in all_songs(db)]
+    columns = LibraryColumns(db)
+    assert len(columns) == len(songs)
+
+    per_artist = {}
+    for song in songs:
+      per_artist[song['artist']] = (per_artist.get(song['artist'], 0)
+                                    + int(song['length']))
+    assert columns.total_by('artist', 'length') == per_artist
+    assert sum(columns.count_by('artist').values()) == len(songs)
+
+    recent = columns.where('year', low=2000)
+    assert recent.sum() == len([s for s in songs if int(s['year']) >= 2000])
+
+  with_index(aggregate)
+
 def test_search_album():
 
   def search_album(db):